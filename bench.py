@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+# Offline benchmark of the plotting pipeline.
+#
+# Writes synthetic DPC- and JHU-shaped CSV files with the requested
+# number of entities and days, checks that the fast paths agree with
+# the slow ones (a Dataset read back from the binary store equals the
+# one written, and the last point of rolling_expfit() equals expfit()),
+# then times each stage separately: loading (from CSV and from the
+# binary store), fitting, smoothing, league tables, rendering and html
+# assembly.
+# Startup is measured too: the import time of the modules in a new
+# interpreter, and the time for a Pool of each start method to be ready
+# to draw.
+#
+# Usage: bench.py [--regions N] [--provinces N] [--nations N] [--days N]
+#                 [--render N] [--n_proc N] [--dir DIR]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import shared
+import store
+import summary
+
+from covid import Styles, CovidPlot, DailyPlot, OOPlot, flush
+from dataset import Dataset
+from metrics import Metrics
+from fitting import expfit, rolling_expfit
+from pages import PageBuilder
+from scheduler import Scheduler
+
+
+def synthetic_curves(rng, entities, days, scale):
+
+    # Cumulative counts with a randomly damped exponential growth
+    rate = rng.uniform(0.05, 0.3, (entities, 1))
+    damping = rng.uniform(0.002, 0.02, (entities, 1))
+    t = np.arange(days)[None, :]
+    daily = scale * rng.uniform(0.1, 1, (entities, 1)) * np.exp(rate * t - damping * t * t / 2)
+    daily *= rng.uniform(0.5, 1.5, daily.shape)
+    return np.cumsum(np.minimum(daily, 1e7).astype('int64'), axis=1)
+
+def write_dpc(dirname, rng, regions, provinces, days):
+
+    dates = pd.date_range('2020-02-24', periods=days).strftime('%Y-%m-%dT17:00:00')
+    casi = synthetic_curves(rng, regions, days, 100)
+    region_names = ['Regione %03d' % i for i in range(regions)]
+
+    rows = pd.DataFrame({
+        'data': np.tile(dates, regions),
+        'stato': 'ITA',
+        'codice_regione': np.repeat(np.arange(regions) + 1, days),
+        'denominazione_regione': np.repeat(region_names, days),
+        'terapia_intensiva': (casi // 20).ravel(),
+        'deceduti': (casi // 10).ravel(),
+        'totale_casi': casi.ravel(),
+        'tamponi': (casi * 5).ravel()})
+    csv_regioni = os.path.join(dirname, 'dpc-covid19-ita-regioni.csv')
+    rows.to_csv(csv_regioni, index=False)
+
+    nazione = rows.groupby('data')[['terapia_intensiva', 'deceduti', 'totale_casi', 'tamponi']].sum()
+    nazione.insert(0, 'stato', 'ITA')
+    csv_nazione = os.path.join(dirname, 'dpc-covid19-ita-andamento-nazionale.csv')
+    nazione.to_csv(csv_nazione)
+
+    # Provinces are spread over the regions, plus one row per region for
+    # the cases not yet assigned to a province (without sigla_provincia)
+    region_of = np.arange(provinces) % regions
+    casi = synthetic_curves(rng, provinces, days, 20)
+    sigle = ['P%03d' % i for i in range(provinces)] + [''] * regions
+    codes = np.concatenate([region_of, np.arange(regions)])
+    casi = np.concatenate([casi, casi[:regions] // 10])
+    rows = pd.DataFrame({
+        'data': np.tile(dates, len(sigle)),
+        'stato': 'ITA',
+        'codice_regione': np.repeat(codes + 1, days),
+        'denominazione_regione': np.repeat(np.array(region_names)[codes], days),
+        'codice_provincia': np.repeat(np.arange(len(sigle)) + 1, days),
+        'sigla_provincia': np.repeat(sigle, days),
+        'totale_casi': casi.ravel()})
+    csv_province = os.path.join(dirname, 'dpc-covid19-ita-province.csv')
+    rows.to_csv(csv_province, index=False)
+
+    return csv_regioni, csv_province, csv_nazione
+
+def write_jhu(dirname, rng, nations, days):
+
+    dates = pd.date_range('2020-01-22', periods=days)
+    columns = ['%d/%d/%02d' % (d.month, d.day, d.year % 100) for d in dates]
+
+    # A few nations are split in several provinces, as in the real files
+    names = ['Nation %03d' % i for i in range(nations)]
+    names += names[:nations // 10] * 3
+    filenames = {}
+    for column, scale in [('Confirmed', 1000), ('Deaths', 50)]:
+        a = pd.DataFrame(synthetic_curves(rng, len(names), days, scale), columns=columns)
+        a.insert(0, 'Long', 0.0)
+        a.insert(0, 'Lat', 0.0)
+        a.insert(0, 'Country/Region', names)
+        a.insert(0, 'Province/State', '')
+        filenames[column] = os.path.join(dirname, 'time_series_covid19_%s_global.csv' % column.lower())
+        a.to_csv(filenames[column], index=False)
+    return filenames
+
+
+class Stages():
+
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, items, func, *args):
+        t0 = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - t0
+        self.results.append((name, elapsed, items))
+        return result
+
+    def report(self, f=sys.stdout):
+        f.write('%-36s %10s %10s %12s\n' % ('stage', 'seconds', 'items', 'items/s'))
+        for name, elapsed, items in self.results:
+            f.write('%-36s %10.3f %10d %12.1f\n' % (name, elapsed, items, items / max(elapsed, 1e-9)))
+
+
+def check_store(dirname, dataset):
+
+    # A Dataset read back from the store equals the one written, with
+    # counts beyond int32 kept as int64
+    big = dataset.columns[next(iter(dataset.columns))].astype('int64') + 2**31
+    columns = dict(dataset.columns, big=big)
+    written = Dataset(dataset.names, dataset.dates, columns, dataset.present, dataset.labels)
+    filename = os.path.join(dirname, 'check.cvds')
+    store.write(filename, written, [])
+    names, dates, columns, present, labels = store.read(filename)
+    assert list(names) == list(written.names), 'store: names differ'
+    assert np.array_equal(dates, written.dates.values.astype('datetime64[D]')), 'store: dates differ'
+    assert np.array_equal(present, written.present), 'store: presence mask differs'
+    assert labels == written.labels, 'store: labels differ'
+    assert columns.keys() == written.columns.keys(), 'store: columns differ'
+    for column, m in columns.items():
+        assert np.array_equal(m, written.columns[column]), 'store: %s differs' % column
+    assert columns['big'].dtype == np.dtype('<i8'), 'store: big counts not kept as int64'
+
+def check_fit(datasets, npoints=10):
+
+    # The last point of the rolling fit is the fit over the last points
+    for dataset, columns in datasets:
+        x = np.arange(len(dataset.dates))
+        for column in columns:
+            a, b = expfit(x, dataset.columns[column], npoints)
+            ra, rb = rolling_expfit(x, dataset.columns[column], npoints)
+            assert np.allclose(ra[:, -1], a[:, 0], equal_nan=True), 'rolling_expfit: %s slope differs' % column
+            assert np.allclose(rb[:, -1], b[:, 0], equal_nan=True), 'rolling_expfit: %s intercept differs' % column
+
+def fit_all(datasets, npoints=10, days_back=(0, 1, 2, 7)):
+    for dataset, columns in datasets:
+        x = np.arange(len(dataset.dates))
+        for column in columns:
+            expfit(x, dataset.columns[column], npoints, days_back)
+
+def rolling_fit_all(datasets, npoints=10):
+    for dataset, columns in datasets:
+        x = np.arange(len(dataset.dates))
+        for column in columns:
+            rolling_expfit(x, dataset.columns[column], npoints)
+
+def smooth_all(datasets):
+    for dataset, columns in datasets:
+        Metrics(dataset).precompute(columns)
+
+def league_all(dataset, columns):
+
+    # Synthetic populations: the bench nations are not in population.csv
+    metrics = Metrics(dataset, np.geomspace(1e4, 1e9, len(dataset.names)))
+    for column in columns:
+        summary.league(metrics, column)
+
+def render(outdir, dataset, metrics, names):
+    for name in names:
+        p = CovidPlot('en', title=name)
+        p.plot(*dataset.series(name, 'Confirmed'), label='Total cases', **Styles.totalecasi)
+        p.plot(*dataset.series(name, 'Deaths'), label='Deaths', **Styles.deceduti)
+        p.expfit(*dataset.series(name, 'Confirmed'), **Styles.expfit1)
+        p.expfit(*dataset.series(name, 'Deaths'), **Styles.expfit2)
+        p.save(os.path.join(outdir, '%s.png' % name))
+
+        p = DailyPlot('en', title='%s - daily cases' % name)
+        p.plot_daily(*metrics.daily_series(name, 'Confirmed'), label='New cases', **Styles.totalecasi)
+        p.plot_daily(*metrics.daily_series(name, 'Deaths'), label='Deaths', **Styles.deceduti)
+        p.save(os.path.join(outdir, '%s_daily.png' % name))
+
+        p = OOPlot('en', title='%s - Cases' % name)
+        _, cases = dataset.series(name, 'Confirmed')
+        p.plot(cases, smooth=False, **Styles.faintline)
+        p.plot_curve(metrics.smoothed_series(name, 'Confirmed'))
+        p.save(os.path.join(outdir, '%s_cases_oo.png' % name))
+    flush()
+
+def fragment(name):
+    return ''.join('<img src="%s_%d.png">\n' % (name, i) for i in range(4))
+
+def assemble(outdir, names, n_proc):
+    builder = PageBuilder(outdir, quiet=True)
+    scheduler = Scheduler()
+    builder.submit(scheduler, 'nations', [(fragment, 1)], names)
+    with shared.pool(n_proc, []) as pool:
+        scheduler.start(pool)
+        with builder.index() as f:
+            builder.write_section(f, 'nations', names)
+
+
+def import_module(module):
+    subprocess.run([sys.executable, '-c', 'import ' + module], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def warm(_):
+
+    # What a worker imports before drawing its first plot
+    import matplotlib.dates
+    import scipy.signal
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+def start_pool(method, n_proc):
+    shared.start_method = method
+    with shared.pool(n_proc, []) as pool:
+        pool.map(warm, range(n_proc))
+
+def startup(stages, n_proc):
+    for module in ['covid', 'italia', 'matplotlib.pyplot', 'scipy.signal']:
+        stages.run('import %s (processes)' % module, 1, import_module, module)
+    for method in multiprocessing.get_all_start_methods():
+        stages.run('pool %s (workers)' % method, n_proc, start_pool, method, n_proc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the plotting pipeline on synthetic data')
+    parser.add_argument('--regions', type=int, default=21)
+    parser.add_argument('--provinces', type=int, default=107)
+    parser.add_argument('--nations', type=int, default=190)
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument('--render', type=int, default=10, help='number of nations to render')
+    parser.add_argument('--n_proc', type=int, default=1)
+    parser.add_argument('--dir', help='keep the synthetic data and images in this directory')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    tmp = None
+    if args.dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        dirname = tmp.name
+    else:
+        dirname = args.dir
+        os.makedirs(dirname, exist_ok=True)
+
+    store.store_dir = os.path.join(dirname, 'store')
+    stages = Stages()
+    try:
+        csv_regioni, csv_province, csv_nazione = stages.run(
+                'generate dpc (rows)', (args.regions + args.provinces) * args.days,
+                write_dpc, dirname, rng, args.regions, args.provinces, args.days)
+        jhu = stages.run('generate jhu (rows)', args.nations * 2,
+                         write_jhu, dirname, rng, args.nations, args.days)
+
+        dpc_columns = ['totale_casi', 'terapia_intensiva', 'deceduti', 'tamponi']
+        regioni = stages.run('load dpc regions (rows)', args.regions * args.days,
+                             Dataset.from_long_csv, csv_regioni, 'denominazione_regione', dpc_columns)
+        province = stages.run('load dpc provinces (rows)', args.provinces * args.days,
+                              Dataset.from_long_csv, csv_province, 'sigla_provincia', ['totale_casi'])
+        world = stages.run('load jhu (nations)', args.nations,
+                           Dataset.from_wide_csv, jhu, 'Country/Region')
+
+        # The loads above wrote the binary stores, read back here
+        stages.run('store dpc regions (rows)', args.regions * args.days,
+                   Dataset.from_long_csv, csv_regioni, 'denominazione_regione', dpc_columns)
+        stages.run('store dpc provinces (rows)', args.provinces * args.days,
+                   Dataset.from_long_csv, csv_province, 'sigla_provincia', ['totale_casi'])
+        stages.run('store jhu (nations)', args.nations,
+                   Dataset.from_wide_csv, jhu, 'Country/Region')
+
+        datasets = [(regioni, ['totale_casi', 'deceduti']),
+                    (province, ['totale_casi']),
+                    (world, ['Confirmed', 'Deaths'])]
+        n_series = args.regions * 2 + args.provinces + args.nations * 2
+        stages.run('check store (entities)', len(regioni.names), check_store, dirname, regioni)
+        stages.run('check rolling fit (series)', n_series, check_fit, datasets)
+        # Imported lazily by the first plot, timed separately below
+        warm(None)
+        stages.run('fit (series)', n_series, fit_all, datasets)
+        stages.run('rolling fit (series x dates)', n_series * args.days, rolling_fit_all, datasets)
+        stages.run('smooth (series)', n_series, smooth_all, datasets)
+        stages.run('league tables (series x dates)', args.nations * 2 * args.days,
+                   league_all, world, ['Confirmed', 'Deaths'])
+
+        metrics = Metrics(world)
+        metrics.precompute(['Confirmed', 'Deaths'])
+        names = world.names[:args.render]
+        outdir = os.path.join(dirname, 'output')
+        os.makedirs(outdir, exist_ok=True)
+        stages.run('render (plots)', len(names) * 3, render, outdir, world, metrics, names)
+        stages.run('html (entities)', len(world.names), assemble, outdir, world.names, args.n_proc)
+        startup(stages, args.n_proc)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    stages.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,41 @@
 #!/usr/bin/env python
 
-import random
+import io
+import hashlib
 import os.path
+import threading
+import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy.signal import savgol_filter
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+
+from fitting import expfit, expcurve
+from fitting import doubling_time as doubling_time_of
+from settings import setting
+from timing import timer
+
+# 'pyplot' or 'agg', see Plot
+renderer = setting('renderer', 'pyplot')
+# 'png' or 'svg', for the full size images
+image_format = setting('image_format', 'png')
+# Resolution of the png thumbnails shown in the pages in place of the
+# full images, which are then only linked. None for no thumbnails.
+thumbnail_dpi = setting('thumbnail_dpi', None)
+# zlib level of the png files, None for the default of Pillow
+png_compress_level = setting('png_compress_level', None)
+# Threads encoding and writing the images while the next one is drawn,
+# 0 to write them before save() returns
+encode_threads = setting('encode_threads', 2)
+templates = threading.local()
+
+# matplotlib and scipy are imported only by the methods that draw, so
+# scripts and workers whose plots are all up to date never load them
+mpl_version = None
+# Hash of the source of this module and of the fits, part of the key of
+# every image, so that changing how plots are drawn redraws them
+code_version = None
+
+encoder = None
+pending = []
 
 
 
@@ -44,6 +74,33 @@ i18n['en']['NumberOfDailyDeaths'] = 'Number of deaths per day'
 i18n['it']['PositiveCases'] = 'Positivi'
 i18n['en']['PositiveCases'] = 'Positive results'
 
+i18n['it']['DoublingTime'] = 'Tempo di raddoppio (gg)'
+i18n['en']['DoublingTime'] = 'Doubling time (days)'
+
+i18n['it']['Latest'] = 'Totale'
+i18n['en']['Latest'] = 'Total'
+
+i18n['it']['NewToday'] = 'Nuovi'
+i18n['en']['NewToday'] = 'New'
+
+i18n['it']['NewLastWeek'] = 'Nuovi in 7 giorni'
+i18n['en']['NewLastWeek'] = 'New in 7 days'
+
+i18n['it']['WeeklyChange'] = 'Variazione sui 7 giorni prima (%)'
+i18n['en']['WeeklyChange'] = 'Change from the 7 days before (%)'
+
+i18n['it']['Per100k'] = 'Totale ogni 100mila abitanti'
+i18n['en']['Per100k'] = 'Total per 100k inhabitants'
+
+i18n['it']['NewLastWeekPer100k'] = 'Nuovi in 7 giorni ogni 100mila abitanti'
+i18n['en']['NewLastWeekPer100k'] = 'New in 7 days per 100k inhabitants'
+
+i18n['it']['DailyMean'] = 'media su 7 giorni'
+i18n['en']['DailyMean'] = '7-day mean'
+
+i18n['it']['Index'] = 'Indice'
+i18n['en']['Index'] = 'Index'
+
 class Styles():
 
     totalecasi = {'marker':'o',
@@ -113,153 +170,563 @@ class Table():
         content = ''.join(args)
         return '<table %s>%s</table>\n' % (self.attributes, content)
 
-class DailyPlot():
+def write_file(filename, data):
+
+    # Written only if different from the file already there, keeping
+    # its mtime otherwise, and under a temporary name until complete
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return
+    except FileNotFoundError:
+        pass
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(filename + '.tmp', filename)
+
+def write_png(filename, rgba, dpi):
+    import matplotlib.image
+    buf = io.BytesIO()
+    pil_kwargs = {'compress_level': png_compress_level} if png_compress_level is not None else None
+    matplotlib.image.imsave(buf, rgba, format='png', origin='upper', dpi=dpi, pil_kwargs=pil_kwargs)
+    write_file(filename, buf.getvalue())
+
+def run(job, *args):
+
+    # Runs job in the encoder threads (zlib and file writes release the
+    # GIL). Its errors are raised by flush().
+    global encoder
+    if not encode_threads:
+        job(*args)
+        return
+    if encoder is None:
+        encoder = ThreadPoolExecutor(encode_threads)
+    pending.append(encoder.submit(job, *args))
+
+def flush():
+
+    # Waits for the images of this process to be on disk
+    while pending:
+        pending.pop(0).result()
+
+
+class Raster(io.BytesIO):
+
+    # File-like object keeping the RGBA buffer of savefig(format='rgba')
+    # as an array, with its shape
+
+    def write(self, buffer):
+        self.rgba = np.array(buffer)
+
+
+class PlotCache():
+
+    # Remembers, for each output directory, the key of the inputs each
+    # image was last rendered from, and the hash of its content used
+    # in its URL. Workers append "name key:hash" lines to the manifest
+    # (short O_APPEND writes do not interleave), and the manifest is
+    # compacted every time it is loaded.
+
+    def __init__(self):
+        self.manifests = {}
+
+    def load(self, outdir):
+        filename = os.path.join(outdir, '.plots_manifest')
+        keys = {}
+        try:
+            with open(filename) as f:
+                for line in f:
+                    name, key = line.rstrip('\n').rsplit(' ', 1)
+                    keys[name] = key
+        except FileNotFoundError:
+            pass
+
+        with open(filename + '.tmp', 'w') as f:
+            f.writelines('%s %s\n' % item for item in keys.items())
+        os.replace(filename + '.tmp', filename)
+        self.manifests[os.path.abspath(outdir)] = (filename, keys)
+
+    def fresh(self, filename, key):
+
+        # Hash of the content of filename if it is up to date, else None
+        outdir, name = os.path.split(os.path.abspath(filename))
+        if outdir not in self.manifests:
+            return None
+        _, keys = self.manifests[outdir]
+        stored, _, content = keys.get(name, '').partition(':')
+        if stored == key and content and os.path.exists(filename):
+            return content
+        return None
+
+    def store(self, filename, key, content):
+        outdir, name = os.path.split(os.path.abspath(filename))
+        if outdir in self.manifests:
+            manifest, keys = self.manifests[outdir]
+            keys[name] = '%s:%s' % (key, content)
+            with open(manifest, 'a') as f:
+                f.write('%s %s:%s\n' % (name, key, content))
+
+plot_cache = PlotCache()
+
+
+class Plot():
+
+    # Drawing calls are recorded and hashed, and only replayed in save()
+    # if the image is not already up to date according to plot_cache.
+    #
+    # With renderer = 'agg' figures are built with the object oriented
+    # Agg API, without pyplot, and each thread keeps one template figure
+    # per plot type and configuration. The template is cleared and
+    # reused for the next plot instead of being rebuilt.
+
+    def __init__(self, title, *config):
+        global mpl_version, code_version
+        if mpl_version is None:
+            mpl_version = importlib.metadata.version('matplotlib')
+        if code_version is None:
+            import fitting
+            code = hashlib.sha1()
+            for filename in [__file__, fitting.__file__]:
+                with open(filename, 'rb') as f:
+                    code.update(f.read())
+            code_version = code.hexdigest()
+        self.title = title
+        self.config = config
+        self.ops = []
+        self.digest = hashlib.sha1()
+        self.digest.update(repr((type(self).__name__, mpl_version, code_version, image_format, thumbnail_dpi,
+                                 title) + config).encode())
+
+    def record(self, method, *args, **kwargs):
+        self.digest.update(method.__name__.encode())
+        for arg in args:
+            if np.ndim(arg) > 0:
+                arg = np.asarray(arg)
+                self.digest.update(repr((arg.dtype, arg.shape)).encode())
+                self.digest.update(np.ascontiguousarray(arg).tobytes())
+            else:
+                self.digest.update(repr(arg).encode())
+        self.digest.update(repr(sorted(kwargs.items())).encode())
+        self.ops.append((method, args, kwargs))
+
+    def template(self):
+        key = (type(self).__name__,) + self.config
+        figures = templates.__dict__.setdefault('figures', {})
+        if key not in figures:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            fig = Figure()
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            self.setup(ax)
+            figures[key] = (fig, ax)
+        return figures[key]
+
+    def render(self):
+        with timer.stage('figure'):
+            if renderer == 'agg':
+                self.fig, self.ax = self.template()
+                self.ax.set_title(self.title if self.title is not None else '')
+            else:
+                import matplotlib.pyplot as plt
+                self.fig, self.ax = plt.subplots()
+                self.setup(self.ax)
+                if self.title is not None:
+                    self.ax.set_title(self.title)
+        for method, args, kwargs in self.ops:
+            method(*args, **kwargs)
+        self.finish()
+
+    def finish(self):
+        self.ax.legend()
+
+    def close(self):
+        if renderer == 'agg':
+            clear(self.ax)
+        else:
+            import matplotlib.pyplot as plt
+            plt.close(self.fig)
+
+    def write(self, filename, key, dpi=None):
+
+        # Returns a hash of the image. A png is only rasterized here, and
+        # encoded and written by the encoder threads, see run().
+        import matplotlib
+        fmt = os.path.splitext(filename)[1][1:]
+        dpi = self.fig.dpi if dpi is None else dpi
+        if fmt == 'png':
+            return self.write_raster(filename, key, self.rasterize(dpi), dpi)
+        buf = io.BytesIO()
+        with matplotlib.rc_context({'svg.hashsalt': 'covid_plots'}):
+            self.fig.savefig(buf, format=fmt, metadata={'Date': None}, dpi=dpi)
+        content = hashlib.sha1(buf.getvalue()).hexdigest()[:16]
+        run(self.written, (write_file, filename, buf.getvalue()), filename, key, content)
+        return content
+
+    def rasterize(self, dpi):
+        raster = Raster()
+        self.fig.savefig(raster, format='rgba', dpi=dpi)
+        return raster.rgba
+
+    def write_raster(self, filename, key, rgba, dpi):
+        content = hashlib.sha1(repr((rgba.shape, dpi, png_compress_level)).encode())
+        content.update(rgba.tobytes())
+        content = content.hexdigest()[:16]
+        run(self.written, (write_png, filename, rgba, dpi), filename, key, content)
+        return content
+
+    @staticmethod
+    def written(job, filename, key, content):
+        job[0](*job[1:])
+        plot_cache.store(filename, key, content)
+
+    def save(self, filename):
+
+        # filename is given with any extension, the image is written in
+        # image_format, plus a _small.png thumbnail if configured. URLs
+        # carry a hash of the content, so that they change only when the
+        # image does.
+        base = os.path.splitext(filename)[0]
+        filename = base + '.' + image_format
+        thumbnail = base + '_small.png' if thumbnail_dpi else None
+        key = self.digest.hexdigest()
+        content = plot_cache.fresh(filename, key)
+        small = plot_cache.fresh(thumbnail, key) if thumbnail else None
+        if content is None or (thumbnail and small is None):
+            self.render()
+            with timer.stage('savefig'):
+                content = self.write(filename, key)
+                if thumbnail:
+                    small = self.write(thumbnail, key, dpi=thumbnail_dpi)
+            self.close()
+        if thumbnail:
+            return '<a href="%s?%s"><img src="%s?%s" loading="lazy"></a>\n' % (
+                os.path.basename(filename), content, os.path.basename(thumbnail), small)
+        return '<img src="%s?%s" loading="lazy">\n' % (os.path.basename(filename), content)
+
+def clear(ax):
+
+    # Removes what was drawn on a template axes, keeping its setup
+    if ax.get_legend() is not None:
+        ax.get_legend().remove()
+    for container in list(ax.containers):
+        container.remove()
+    for artist in list(ax.lines) + list(ax.patches) + list(ax.collections) + list(ax.texts):
+        artist.remove()
+    ax.relim()
+    ax.set_prop_cycle(None)
+
+class DailyPlot(Plot):
 
     def __init__(self, lang='it', title=None, ymax=1e5):
-        self.fig, ax = plt.subplots()
+        super().__init__(title, lang, ymax)
+        self.lang = lang
+        self.ymax = ymax
+
+    def setup(self, ax):
+        import matplotlib.dates as mdates
         ax.xaxis_date()
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
         ax.yaxis.set_ticks_position('both')
         ax.tick_params(labeltop=False, labelright=True)
-        plt.yscale('log')
-        plt.ylim(ymin=1, ymax=ymax)
-        plt.xlabel(i18n[lang]['Date'])
-        plt.ylabel(i18n[lang]['NumberOfCases'])
-        if title is not None:
-            plt.title(title)
+        ax.set_yscale('log')
+        ax.set_ylim(bottom=1, top=self.ymax)
+        ax.set_xlabel(i18n[self.lang]['Date'])
+        ax.set_ylabel(i18n[self.lang]['NumberOfCases'])
 
     def plot(self, data, casi, **kwargs):
+        self.record(self._plot, data, casi, **kwargs)
+
+    def plot_daily(self, data, daily, **kwargs):
+        # Daily values already computed, e.g. by Metrics.daily_series()
+        self.record(self._plot_daily, data, daily, **kwargs)
+
+    def _plot(self, data, casi, **kwargs):
 
         daily = casi[1:] - casi[0:-1]
-        plt.plot(data[1:], daily, **kwargs)
+        self.ax.plot(data[1:], daily, **kwargs)
 
-    def save(self, filename):
-        plt.legend()
-        plt.savefig(filename)
-        plt.close(self.fig)
-        suffix = str(random.random())
-        return '<img src="%s?%s">\n' % (os.path.basename(filename), suffix)
+    def _plot_daily(self, data, daily, **kwargs):
+
+        self.ax.plot(data, daily, **kwargs)
 
-class TestsPlot():
+class TestsPlot(Plot):
 
     def __init__(self, lang='it', title=None):
-        self.fig, ax = plt.subplots()
+        super().__init__(title, lang)
+        self.lang=lang
+
+    def setup(self, ax):
+        import matplotlib.dates as mdates
         ax.xaxis_date()
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
         ax.yaxis.set_ticks_position('both')
         ax.tick_params(labeltop=False, labelright=True)
-        plt.xlabel(i18n[lang]['Date'])
-        plt.ylabel(i18n[lang]['NumberOfTests'])
-        if title is not None:
-            plt.title(title)
-        self.lang=lang
+        ax.set_xlabel(i18n[self.lang]['Date'])
+        ax.set_ylabel(i18n[self.lang]['NumberOfTests'])
 
     def plot(self, dates, y, shift=0, **kwargs):
+        self.record(self._plot, dates, y, shift, **kwargs)
 
-        dd = mdates.date2num(dates)
-        plt.bar(dd+shift, y, **kwargs)
+    def _plot(self, dates, y, shift=0, **kwargs):
 
-    def save(self, filename):
-        plt.legend()
-        plt.savefig(filename)
-        plt.close(self.fig)
-        suffix = str(random.random())
-        return '<img src="%s?%s">\n' % (os.path.basename(filename), suffix)
+        import matplotlib.dates as mdates
+        dd = mdates.date2num(dates)
+        self.ax.bar(dd+shift, y, **kwargs)
 
 def running_mean(x, N):
     cumsum = np.cumsum(np.insert(x, 0, 0)) 
     return (cumsum[N:] - cumsum[:-N]) / float(N)
 
-class OOPlot():
+class OOPlot(Plot):
 
     def __init__(self, lang='it', title=None,
                        xlabel='NumberOfCases',
 		       ylabel='NumberOfDailyCases'):
-        self.fig, ax = plt.subplots()
+        super().__init__(title, lang, xlabel, ylabel)
+        self.lang = lang
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.legend=False
+
+    def setup(self, ax):
         ax.yaxis.set_ticks_position('both')
         ax.tick_params(labeltop=False, labelright=True)
-        plt.yscale('log')
-        plt.xscale('log')
-        plt.xlabel(i18n[lang][xlabel])
-        plt.ylabel(i18n[lang][ylabel])
-        if title is not None:
-            plt.title(title)
-        self.legend=False
+        ax.set_yscale('log')
+        ax.set_xscale('log')
+        ax.set_xlabel(i18n[self.lang][self.xlabel])
+        ax.set_ylabel(i18n[self.lang][self.ylabel])
 
     def plot(self, series, wsize=15, order=3, smooth=True, **kwargs):
+        self.record(self._plot, series, wsize, order, smooth, **kwargs)
+
+    def plot_curve(self, x, **kwargs):
+        # Curve already smoothed, e.g. by Metrics.smoothed_series()
+        self.record(self._plot_curve, x, **kwargs)
+
+    def _plot(self, series, wsize=15, order=3, smooth=True, **kwargs):
 
         series = series[np.where(series>=10)]
         if smooth:
             if len(series) < wsize+2:
                 return
-            log_series = np.log(series)
-            x = savgol_filter(log_series, wsize, order)
-            x = np.exp(x)
+            with timer.stage('smooth'):
+                from scipy.signal import savgol_filter
+                log_series = np.log(series)
+                x = savgol_filter(log_series, wsize, order)
+                x = np.exp(x)
         else:
             x = series
+        self._plot_curve(x, **kwargs)
+
+    def _plot_curve(self, x, **kwargs):
+
+        if x is None:
+            return
         daily = x[1:] - x[:-1]
-        plt.plot(x[1:], daily, **kwargs)
+        self.ax.plot(x[1:], daily, **kwargs)
 
         if 'legend' in kwargs:
             self.legend=True
 
-    def save(self, filename):
+    def finish(self):
         if self.legend:
-            plt.legend()
-        plt.savefig(filename)
-        plt.close(self.fig)
-        suffix = str(random.random())
-        return '<img src="%s?%s">\n' % (os.path.basename(filename), suffix)
+            self.ax.legend()
 
 
-class CovidPlot():
+class CovidPlot(Plot):
 
     def __init__(self, lang='it', title=None, ymax=1e6):
-        self.fig, ax = plt.subplots()
+        super().__init__(title, lang, ymax)
+        self.lang = lang
+        self.ymax = ymax
+
+    def setup(self, ax):
+        import matplotlib.dates as mdates
         ax.xaxis_date()
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
         ax.yaxis.set_ticks_position('both')
         ax.tick_params(labeltop=False, labelright=True)
-        plt.yscale('log')
-        plt.ylim(ymin=1, ymax=ymax)
-        plt.xlabel(i18n[lang]['Date'])
-        plt.ylabel(i18n[lang]['NumberOfCases'])
-        if title is not None:
-            plt.title(title)
+        ax.set_yscale('log')
+        ax.set_ylim(bottom=1, top=self.ymax)
+        ax.set_xlabel(i18n[self.lang]['Date'])
+        ax.set_ylabel(i18n[self.lang]['NumberOfCases'])
 
     def plot(self, data, casi, **kwargs):
+        self.record(self._plot, data, casi, **kwargs)
+
+    def _plot(self, data, casi, **kwargs):
 
-        plt.plot(data, casi, **kwargs)
+        self.ax.plot(data, casi, **kwargs)
 
     def expfit(self, data, casi, npoints=10, days_back=0, label='default', **kwargs):
+        self.record(self._expfit, data, casi, npoints, days_back, label, **kwargs)
+
+    def _expfit(self, data, casi, npoints=10, days_back=0, label='default', **kwargs):
 
         # Exponential fittings over the last points
         if len(data) >= npoints+days_back:
             x = (data - min(data)).dt.days.to_numpy()
-            if isinstance(casi, np.ndarray):
-                y = casi
-            else:
-                y = casi.to_numpy()
-            r = range(npoints+days_back,days_back,-1)
-            xx = np.array([[x[-j], 1] for j in r])
-            yy = np.array([y[-j] for j in r]).astype(np.float32)
-            if not np.all(yy>0):
+            with timer.stage('fit'):
+                a, b = expfit(x, np.asarray(casi), npoints, days_back)
+            if np.isnan(a[0,0]):
                 return
-            # Set rcond=-1 to avoid a warning
-            a,b = np.linalg.lstsq(xx, np.log(yy), rcond=-1)[0]
-            exp_casi = np.exp(a*x+b)
+            exp_casi = expcurve(x, a, b)[0,0]
             exp_data = data
-            doubling_time = np.log(2)/a
+            doubling_time = doubling_time_of(a[0,0])
             if label == 'default':
                 label = 'T raddoppio = %.1f gg' % doubling_time
             if not label:
                 label=None
-            plt.plot(exp_data, exp_casi, label=label, **kwargs)
+            self.ax.plot(exp_data, exp_casi, label=label, **kwargs)
 
-    def save(self, filename):
-        plt.legend()
-        plt.savefig(filename)
-        plt.close(self.fig)
-        suffix = str(random.random())
-        return '<img src="%s?%s">\n' % (os.path.basename(filename), suffix)
 
+class DoublingTimePlot(Plot):
+
+    # Doubling time of the exponential fit over the last days, for each
+    # date, e.g. from Metrics.doubling_series()
+
+    def __init__(self, lang='it', title=None, ymax=50):
+        super().__init__(title, lang, ymax)
+        self.lang = lang
+        self.ymax = ymax
+
+    def setup(self, ax):
+        import matplotlib.dates as mdates
+        ax.xaxis_date()
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
+        ax.yaxis.set_ticks_position('both')
+        ax.tick_params(labeltop=False, labelright=True)
+        ax.set_ylim(bottom=0, top=self.ymax)
+        ax.set_xlabel(i18n[self.lang]['Date'])
+        ax.set_ylabel(i18n[self.lang]['DoublingTime'])
+
+    def plot(self, data, doubling_time, **kwargs):
+        self.record(self._plot, data, doubling_time, **kwargs)
+
+    def _plot(self, data, doubling_time, **kwargs):
+
+        self.ax.plot(data, doubling_time, **kwargs)
+
+
+class GridPlot(Plot):
+
+    # Small multiples: one panel per entity, drawn with the methods of
+    # plot (e.g. DailyPlot('en')) on axes sharing their scales and
+    # formatters, and rasterized once. The grid is saved as one image,
+    # or cut into an image per entity in place of a figure per entity.
+    # Like those of Plot, grid figures are templates reused by the next
+    # grid of the same type and shape.
+    #
+    #     g = GridPlot(DailyPlot('en'), names)
+    #     for name in names:
+    #         g.panel(name).plot_daily(dates, daily, **style)
+    #     g.save(crops='%s_daily.png')
+
+    def __init__(self, plot, names, ncols=4, title=None):
+        super().__init__(title, type(plot).__name__, plot.config, tuple(names), ncols)
+        self.plot = plot
+        self.names = list(names)
+        self.ncols = min(ncols, max(len(self.names), 1))
+        self.nrows = -(-len(self.names) // self.ncols)
+
+    def panel(self, name):
+        return Panel(self, name)
+
+    def _draw(self, name, method, *args, **kwargs):
+        self.plot.ax = self.axes[name]
+        getattr(self.plot, method)(*args, **kwargs)
+
+    def figure(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(3.6 * self.ncols, 3 * self.nrows))
+        FigureCanvasAgg(fig)
+        grid = fig.subplots(self.nrows, self.ncols, sharex=True, sharey=True, squeeze=False)
+        fig.subplots_adjust(left=0.6 / 3.6 / self.ncols, right=1 - 0.1 / 3.6 / self.ncols,
+                            bottom=0.6 / 3 / self.nrows, top=1 - 0.3 / 3 / self.nrows,
+                            wspace=0.25, hspace=0.45)
+        for ax in grid.flat:
+            self.plot.setup(ax)
+            # Every panel keeps its tick labels, to be cut out alone
+            ax.tick_params(labelsize='x-small', labelbottom=True, labelleft=True, labelright=False)
+            ax.tick_params(axis='x', labelrotation=30)
+            ax.set_xlabel('')
+            ax.set_ylabel('')
+        return fig, list(grid.flat)
+
+    def template(self):
+        key = (type(self).__name__, type(self.plot).__name__, self.plot.config, self.nrows, self.ncols)
+        figures = templates.__dict__.setdefault('figures', {})
+        if key not in figures:
+            figures[key] = self.figure()
+        return figures[key]
+
+    def render(self):
+        with timer.stage('figure'):
+            self.fig, grid = self.template() if renderer == 'agg' else self.figure()
+            self.fig.suptitle(self.title if self.title is not None else '')
+            self.axes = {}
+            for i, ax in enumerate(grid):
+                ax.set_visible(i < len(self.names))
+                if i < len(self.names):
+                    ax.set_title(self.names[i], fontsize='small')
+                    self.axes[self.names[i]] = ax
+        for method, args, kwargs in self.ops:
+            method(*args, **kwargs)
+        for ax in self.axes.values():
+            if ax.get_legend_handles_labels()[0]:
+                ax.legend(fontsize='xx-small')
+
+    def crop(self, rgba, i):
+
+        # The cell of the grid of panel i, with its title and tick labels
+        height, width = rgba.shape[:2]
+        row, col = divmod(i, self.ncols)
+        top, bottom = (height * row // self.nrows, height * (row+1) // self.nrows)
+        left, right = (width * col // self.ncols, width * (col+1) // self.ncols)
+        return np.ascontiguousarray(rgba[top:bottom, left:right])
+
+    def close(self):
+        if renderer == 'agg':
+            for ax in self.axes.values():
+                clear(ax)
+        self.fig = None
+        self.axes = None
+
+    def save(self, filename=None, crops=None):
+
+        # Writes the whole grid to filename, and the panel of each entity
+        # to crops, a file name pattern with %s for the entity. Returns
+        # the html of the grid, or that of each panel when there are crops.
+        targets = ([os.path.splitext(filename)[0] + '.png'] if filename else []) + \
+                  ([crops % name for name in self.names] if crops else [])
+        key = self.digest.hexdigest()
+        contents = [plot_cache.fresh(target, key) for target in targets]
+        if None in contents:
+            self.render()
+            with timer.stage('savefig'):
+                dpi = self.fig.dpi
+                rgba = self.rasterize(dpi)
+                contents = [self.write_raster(targets[0], key, rgba, dpi)] if filename else []
+                if crops:
+                    contents += [self.write_raster(crops % name, key, self.crop(rgba, i), dpi)
+                                 for i, name in enumerate(self.names)]
+            self.close()
+        html = ['<img src="%s?%s" loading="lazy">\n' % (os.path.basename(target), content)
+                for target, content in zip(targets, contents)]
+        return html[-len(self.names):] if crops else html[0]
+
+
+class Panel():
+
+    # Records the calls made to one panel of a GridPlot
+
+    def __init__(self, grid, name):
+        self.grid = grid
+        self.name = name
+
+    def __getattr__(self, method):
+        def record(*args, **kwargs):
+            self.grid.record(self.grid._draw, self.name, '_' + method, *args, **kwargs)
+        return record
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+import shared
+import store
+from timing import timer
+
+
+class Dataset():
+
+    # Time series for a set of entities (regions, provinces, nations...)
+    # stored as one entity x date integer matrix per column: int64 when
+    # parsed, possibly int32 when mapped from a store (see store.py).
+    # present[i,j] is False when entity i has no record for date j.
+    # labels maps the name of an attribute of the entities (e.g. the code
+    # of the region of each province) to its value for each entity.
+
+    def __init__(self, names, dates, columns, present=None, labels=None):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.dates = pd.DatetimeIndex(dates)
+        self.columns = columns
+        if present is None:
+            present = np.ones((len(self.names), len(self.dates)), dtype=bool)
+        self.present = present
+        self.labels = labels if labels is not None else {}
+
+    @staticmethod
+    def cached(sources, params, parse):
+
+        # Returns the dataset parse() builds from the source files,
+        # read from its binary store (see store.py) when none of the
+        # files changed since it was written. A freshly parsed dataset
+        # is read back from the store too, so that both paths give the
+        # same dtypes and the keys of the plots do not depend on it.
+        filename = store.path(sources, params)
+        if filename is None:
+            return parse()
+        stamp = store.stamp(sources)
+        try:
+            header, _ = store.read_header(filename)
+            if header['stamp'] == stamp:
+                with timer.stage('load'):
+                    return Dataset(*store.read(filename))
+        except (OSError, ValueError, KeyError):
+            pass
+
+        dataset = parse()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        store.write(filename, dataset, stamp)
+        return Dataset(*store.read(filename))
+
+    @staticmethod
+    def from_long_csv(filename, key, columns, date_column='data', labels=()):
+
+        # One row per (entity, date), like the DPC files. Only empty
+        # cells are missing values: "NA" is the sigla of Napoli.
+        def parse():
+            with timer.stage('load'):
+                dati = pd.read_csv(filename, keep_default_na=False, na_values=[''])
+            return Dataset.from_frame(dati, key, columns, date_column, labels)
+
+        return Dataset.cached([filename], ['long', key, columns, date_column, list(labels)], parse)
+
+    @staticmethod
+    def from_frame(dati, key, columns, date_column='data', labels=()):
+
+        # Rows without a key (cases not yet assigned to a province) and
+        # repeated headers are dropped. Labels are taken from the last
+        # row of each entity.
+        dati = dati[dati[key].map(lambda x: isinstance(x, str))]
+        dati = dati[dati[key] != key].copy()
+
+        dati[date_column] = pd.to_datetime(dati[date_column]).dt.floor('D')
+        for column in columns:
+            dati[column] = pd.to_numeric(dati[column])
+
+        grouped = dati.groupby([key, date_column])[columns].last()
+        present = pd.Series(True, index=grouped.index).unstack(fill_value=False)
+        names = present.index
+        dates = present.columns
+
+        matrices = {}
+        for column in columns:
+            m = grouped[column].unstack().reindex(index=names, columns=dates)
+            matrices[column] = m.fillna(0).to_numpy().astype('int64')
+
+        last = dati.groupby(key)[list(labels)].last().reindex(names)
+        return Dataset(names, dates, matrices, present.to_numpy(),
+                       {label: last[label].tolist() for label in labels})
+
+    @staticmethod
+    def from_wide_csv(filenames, key, first_column=4, date_format='%m/%d/%y'):
+
+        # One row per entity and one column per date, like the JHU time
+        # series, with one file per column. Rows sharing the same key
+        # (e.g. provinces of the same nation) are summed.
+        def parse():
+            names = None
+            matrices = {}
+            for column, filename in filenames.items():
+                with timer.stage('load'):
+                    a = pd.read_csv(filename)
+                b = a.groupby(key)[list(a.columns[first_column:])].sum()
+                b.columns = pd.to_datetime(b.columns, format=date_format)
+                if names is None:
+                    names = b.index
+                    dates = b.columns
+                b = b.reindex(index=names, columns=dates)
+                matrices[column] = b.fillna(0).to_numpy().astype('int64')
+            return Dataset(names, dates, matrices)
+
+        return Dataset.cached(list(filenames.values()),
+                              ['wide', list(filenames), key, first_column, date_format], parse)
+
+    def share(self):
+
+        # Moves the matrices to shared memory. Pickling the dataset then
+        # sends only the names of the blocks, and worker processes map
+        # the same pages instead of receiving a copy.
+        self.columns = {column: shared.publish(m) for column, m in self.columns.items()}
+        self.present = shared.publish(self.present)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['columns'] = {column: shared.reference(m) for column, m in self.columns.items()}
+        state['present'] = shared.reference(self.present)
+        return state
+
+    def __setstate__(self, state):
+        state['columns'] = {column: shared.attach(m) for column, m in state['columns'].items()}
+        state['present'] = shared.attach(state['present'])
+        self.__dict__.update(state)
+
+    def digests(self):
+
+        # Hash of the dates and values of each entity, to find the
+        # entities whose data changed since a previous run
+        days = self.dates.values.astype('datetime64[D]').astype('<i8')
+        digests = {}
+        for i, name in enumerate(self.names):
+            mask = self.present[i]
+            h = hashlib.sha1(days[mask].tobytes())
+            for column in sorted(self.columns):
+                h.update(column.encode())
+                h.update(self.columns[column][i, mask].astype('<i8').tobytes())
+            digests[name] = h.hexdigest()
+        return digests
+
+    def series(self, name, column):
+
+        i = self.index[name]
+        mask = self.present[i]
+        return (pd.Series(self.dates[mask]), self.columns[column][i, mask])
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Export of the series plotted for each entity as JSON, drawn in the
+# browser by viewer.html instead of as images.
+#
+# <outdir>/data/<section>.json holds, for each entity and column, the
+# dates (days since the origin), the values, the daily deltas (from the
+# second date on, as DailyPlot), the smoothed curve of OOPlot and the
+# exponential fits of CovidPlot:
+#
+#   {"origin": "2020-02-24",
+#    "columns": ["totale_casi", ...],
+#    "entities": {"Lombardia": {"days": [0, 1, ...],
+#                               "totale_casi": {"values": [...],
+#                                               "daily": [...],
+#                                               "smoothed": [...] or null,
+#                                               "fits": [{"days_back": 0, "a": ..., "b": ...,
+#                                                         "doubling_time": ...}, ...],
+#                                               "doubling_time": [...]}}}}
+#
+# A fit is exp(a * (day - days[0]) + b), as drawn by CovidPlot.expfit().
+# The last list is the doubling time of the fit ending at each date, see
+# Metrics.doubling_time(), null where there is no fit or no growth.
+
+import os
+import json
+import shutil
+import numpy as np
+
+from fitting import expfit, doubling_time, min_growth
+from pages import server_charts
+from settings import setting
+from timing import timer
+
+# Write <outdir>/data/<section>.json and <outdir>/viewer.html. Always
+# done when server_charts is False, since the index then links to them.
+json_export = setting('json_export', False) or not server_charts
+
+days_back = [0, 1, 2, 7]
+
+
+def number(x, digits=None):
+    if not np.isfinite(x):
+        return None
+    return round(float(x), digits) if digits is not None else float(x)
+
+def series(dataset, metrics, name, column, days, npoints=10):
+    i = dataset.index[name]
+    values = np.asarray(dataset.columns[column][i, dataset.present[i]])
+    a, b = expfit(days - days[0], values, npoints, days_back)
+    smoothed = metrics.smoothed_series(name, column)
+    _, daily = metrics.daily_series(name, column)
+    _, doubling = metrics.doubling_series(name, column)
+    return {'values': values.tolist(),
+            'daily': np.asarray(daily).tolist(),
+            'smoothed': None if smoothed is None else np.round(smoothed, 2).tolist(),
+            'fits': [{'days_back': d,
+                      'a': number(a[0, j]),
+                      'b': number(b[0, j]),
+                      'doubling_time': number(doubling_time(a[0, j], min_growth), 2)}
+                     for j, d in enumerate(days_back)],
+            'doubling_time': [number(t, 2) for t in doubling]}
+
+def write(outdir, section, dataset, metrics, columns, names=None):
+
+    # Does nothing unless json_export is set
+    if not json_export:
+        return
+    with timer.stage('export'):
+        dates = dataset.dates.values.astype('datetime64[D]')
+        origin = dates[0] if len(dates) else np.datetime64('1970-01-01', 'D')
+        offsets = (dates - origin).astype(int)
+        entities = {}
+        for name in (dataset.names if names is None else names):
+            days = offsets[dataset.present[dataset.index[name]]]
+            entity = {'days': days.tolist()}
+            for column in columns:
+                entity[column] = series(dataset, metrics, name, column, days)
+            entities[name] = entity
+
+        dirname = os.path.join(outdir, 'data')
+        os.makedirs(dirname, exist_ok=True)
+        filename = os.path.join(dirname, '%s.json' % section)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'origin': str(origin), 'columns': columns, 'entities': entities},
+                      f, separators=(',', ':'))
+        os.replace(filename + '.tmp', filename)
+        shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer.html'),
+                        os.path.join(outdir, 'viewer.html'))
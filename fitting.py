@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Growth rates per day at or below this are flat or falling series,
+# whose doubling time is NaN rather than huge, infinite or negative
+min_growth = 1e-4
+
+
+def expfit(x, y, npoints=10, days_back=0):
+
+    # Fit log(y) = a*x + b over the last npoints points of each row of y,
+    # repeated for each offset in days_back. All rows and offsets are
+    # solved at once with the closed form least squares solution.
+    #
+    # x: 1-D array shared by all rows (e.g. days since the first date)
+    # y: 1-D or 2-D array, one series per row
+    #
+    # Returns (a, b), each with shape (rows, offsets). They are NaN where
+    # the window does not fit in the series or has non-positive values.
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    days_back = np.atleast_1d(days_back)
+
+    rows, n = y.shape
+    a = np.full((rows, len(days_back)), np.nan)
+    b = np.full((rows, len(days_back)), np.nan)
+
+    start = n - npoints - days_back
+    ok = start >= 0
+    if not np.any(ok):
+        return a, b
+
+    idx = start[ok, None] + np.arange(npoints)[None, :]
+    xx = x[idx]
+    yy = y[:, idx]
+
+    positive = np.all(yy > 0, axis=2)
+    ly = np.log(np.where(yy > 0, yy, 1))
+
+    xmean = xx.mean(axis=1)
+    xc = xx - xmean[:, None]
+    slope = (ly * xc).sum(axis=2) / (xc * xc).sum(axis=1)
+    intercept = ly.mean(axis=2) - slope * xmean
+
+    a[:, ok] = np.where(positive, slope, np.nan)
+    b[:, ok] = np.where(positive, intercept, np.nan)
+    return a, b
+
+def rolling_expfit(x, y, npoints=10):
+
+    # Same fit as expfit(), over the window of npoints points ending at
+    # every point of each row of y. The sums of the normal equations are
+    # differences of cumulative sums, so the cost does not depend on
+    # npoints.
+    #
+    # Returns (a, b), each with the shape of y, NaN for the first
+    # npoints-1 points and where the window has non-positive values.
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    rows, n = y.shape
+    a = np.full((rows, n), np.nan)
+    b = np.full((rows, n), np.nan)
+    if n < npoints:
+        return a, b
+
+    def window(v):
+        c = np.zeros(v.shape[:-1] + (v.shape[-1]+1,))
+        np.cumsum(v, axis=-1, out=c[..., 1:])
+        return c[..., npoints:] - c[..., :-npoints]
+
+    # x is shifted to start at 0 to keep the sums small
+    x0 = x[0]
+    x = x - x0
+    positive = y > 0
+    ly = np.log(np.where(positive, y, 1))
+
+    sx = window(x)
+    sxx = window(x * x)
+    sy = window(ly)
+    sxy = window(ly * x)
+    bad = window((~positive).astype(np.float64))
+
+    slope = (npoints * sxy - sx * sy) / (npoints * sxx - sx * sx)
+    intercept = (sy - slope * sx) / npoints - slope * x0
+    a[:, npoints-1:] = np.where(bad == 0, slope, np.nan)
+    b[:, npoints-1:] = np.where(bad == 0, intercept, np.nan)
+    return a, b
+
+def expcurve(x, a, b):
+
+    # Fitted curves for the result of expfit(), with shape (rows, offsets, len(x))
+    x = np.asarray(x, dtype=np.float64)
+    return np.exp(a[..., None] * x + b[..., None])
+
+def doubling_time(a, min_growth=None):
+
+    # log(2)/a, NaN where a <= min_growth when one is given
+    with np.errstate(divide='ignore'):
+        t = np.log(2) / a
+    if min_growth is not None:
+        t = np.where(a > min_growth, t, np.nan)
+    return t
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+
+class Hierarchy():
+
+    # Links the entities of a Dataset (e.g. provinces) to their parents
+    # in another one (e.g. regions), through a code that both carry: a
+    # label of the children, and a label or the name of the parents.
+    # Children are sorted by parent once, so that sums over the children
+    # of every parent are a single cumulative sum over the matrices.
+    #
+    #     regioni = Hierarchy(nazione, regioni_ds, 'stato')
+    #     province = Hierarchy(regioni_ds, province_ds, 'codice_regione')
+
+    def __init__(self, parents, children, code):
+        self.upper = parents
+        self.lower = children
+        self.code = code
+        parent_codes = parents.labels.get(code, parents.names)
+        lookup = {c: i for i, c in enumerate(parent_codes)}
+        self.parent = np.array([lookup.get(c, -1) for c in children.labels[code]], dtype=np.intp)
+
+        # Children with a parent, grouped by parent, and where the group
+        # of each parent starts
+        order = np.argsort(self.parent, kind='stable')
+        self.order = order[self.parent[order] >= 0]
+        counts = np.bincount(self.parent[self.order], minlength=len(parents.names))
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+
+        # Date column of the parents for each date of the children, -1
+        # when the parents have no such date
+        self.date_columns = parents.dates.get_indexer(children.dates)
+
+    def children(self, name):
+        i = self.upper.index[name]
+        return [self.lower.names[j] for j in self.order[self.starts[i]:self.starts[i+1]]]
+
+    def parent_of(self, name):
+        i = self.parent[self.lower.index[name]]
+        return self.upper.names[i] if i >= 0 else None
+
+    def sum(self, m):
+
+        # Sum over the children of each parent of m, a children x dates
+        # matrix (a column of the children, or a matrix of Metrics), as
+        # a parents x dates matrix on the dates of the parents
+        rows = np.asarray(m)[self.order]
+        cumsum = np.zeros((len(rows) + 1, rows.shape[1]), dtype=np.promote_types(rows.dtype, np.int64))
+        np.cumsum(rows, axis=0, out=cumsum[1:])
+        sums = cumsum[self.starts[1:]] - cumsum[self.starts[:-1]]
+        out = np.zeros((len(self.upper.names), len(self.upper.dates)), dtype=sums.dtype)
+        valid = self.date_columns >= 0
+        out[:, self.date_columns[valid]] = sums[:, valid]
+        return out
+
+    def check(self, m, column):
+
+        # Inconsistencies between m, a matrix of the children, and
+        # column of the parents, as a list of messages. Parents can count
+        # more than their children (e.g. cases not yet assigned to a
+        # province), never less.
+        messages = []
+        orphans = [self.lower.names[j] for j in np.flatnonzero(self.parent < 0)]
+        if orphans:
+            messages.append('unknown %s for %s' % (self.code, ', '.join(map(str, orphans))))
+        childless = [self.upper.names[i] for i in np.flatnonzero(np.diff(self.starts) == 0)]
+        if childless:
+            messages.append('no children: %s' % ', '.join(map(str, childless)))
+        missing = np.count_nonzero(self.date_columns < 0)
+        if missing:
+            messages.append('%d dates of the children missing from the parents' % missing)
+
+        excess = np.where(self.upper.present, self.sum(m) - self.upper.columns[column], 0)
+        for i in np.flatnonzero((excess > 0).any(axis=1)):
+            j = np.argmax(excess[i])
+            messages.append('%s: children exceed %s on %d dates, by up to %d on %s' %
+                            (self.upper.names[i], column, np.count_nonzero(excess[i] > 0),
+                             excess[i, j], self.upper.dates[j].date()))
+        return messages
@@ -2,11 +2,19 @@
 
 import os
 import sys
-import pandas as pd
-from multiprocessing import Pool
 
 
-from covid import i18n, Styles, CovidPlot, DailyPlot, Table, TestsPlot, OOPlot
+from covid import i18n, Styles, CovidPlot, DailyPlot, DoublingTimePlot, GridPlot, Table, TestsPlot, OOPlot, plot_cache
+from dataset import Dataset
+from hierarchy import Hierarchy
+from metrics import Metrics
+from pages import PageBuilder, check_settings, small_multiples
+from scheduler import Scheduler
+import export
+import population
+import summary
+import shared
+from timing import timer
 
 try:
     from my_config_italia import csv_dir, outdir, n_proc
@@ -15,7 +23,7 @@ except ModuleNotFoundError:
     csv_dir = '../COVID-19-italia'
     homedir = os.getenv('HOME')
     outdir = os.path.join(homedir, 'public_html/coronavirus/italia')
-    n_proc = 1
+    n_proc = os.cpu_count()
 
 
 csv_province = os.path.join(csv_dir, 'dati-province/dpc-covid19-ita-province.csv')
@@ -23,194 +31,308 @@ csv_regioni = os.path.join(csv_dir, 'dati-regioni/dpc-covid19-ita-regioni.csv')
 csv_nazione = os.path.join(csv_dir, 'dati-andamento-nazionale/dpc-covid19-ita-andamento-nazionale.csv')
 
 
-last_update=sys.argv[1]
-
 def lista_province():
-    dati = pd.read_csv(csv_province)
-    province = filter(lambda x: isinstance(x,str), dati.sigla_provincia.unique())
-    # Repeated header becomes a spurious region name
-    return filter(lambda x: x != 'sigla_provincia', province)
+    return province.names
 
 def lista_regioni():
-    dati = pd.read_csv(csv_regioni)
-    regioni = filter(lambda x: isinstance(x,str), dati.denominazione_regione.unique())
-    # Repeated header becomes a spurious region name
-    return filter(lambda x: x != 'denominazione_regione', regioni)
+    return regioni.names
 
 def dati_regione(regione, column):
-
-    dati = pd.read_csv(csv_regioni, parse_dates=['data'])
-    filtro = dati['denominazione_regione'] == regione
-
-    data = pd.to_datetime(dati[filtro]['data']).dt.floor('d')
-    casi = dati[filtro][column].to_numpy().astype('int64')
-
-    return (data, casi)
+    return regioni.series(regione, column)
 
 def dati_nazione( column):
-    dati = pd.read_csv(csv_nazione, parse_dates=['data'])
-    data = pd.to_datetime(dati['data']).dt.floor('d')
-    casi = dati[column].to_numpy().astype('int64')
-    return (data, casi)
+    return nazione.series('ITA', column)
 
 def casi_provincia(sigla):
-    dati = pd.read_csv(csv_province, parse_dates=['data'])
-    filtro = dati['sigla_provincia'] == sigla
-
-    data = pd.to_datetime(dati[filtro]['data']).dt.floor('d')
-    casi = dati[filtro]['totale_casi'].to_numpy().astype('int64')
-    return (data, casi)
-
-try:
-    os.makedirs(outdir)
-except FileExistsError:
-    pass
-
-def plot_provincia(provincia):
-    print(provincia)
-    html = '<H2>%s</H2><a name="%s"></a>' % (provincia, provincia)
-
+    return province.series(sigla, 'totale_casi')
+
+def province_di(regione):
+    # Province di una regione, tramite codice_regione
+    return gerarchia_province.children(regione)
+
+def regione_di(provincia):
+    return gerarchia_province.parent_of(provincia)
+
+def load():
+    global regioni, province, nazione
+    global derivati_regioni, derivati_province, derivati_nazione
+    global gerarchia_regioni, gerarchia_province
+
+    # Each file is parsed once here, before the Pool is created, and the
+    # workers inherit the arrays on fork instead of reading the CSV again.
+    regioni = Dataset.from_long_csv(csv_regioni, 'denominazione_regione',
+                                    ['totale_casi', 'terapia_intensiva', 'deceduti', 'tamponi'],
+                                    labels=['stato', 'codice_regione'])
+    province = Dataset.from_long_csv(csv_province, 'sigla_provincia', ['totale_casi'],
+                                     labels=['codice_regione', 'codice_provincia'])
+    nazione = Dataset.from_long_csv(csv_nazione, 'stato',
+                                    ['totale_casi', 'terapia_intensiva', 'deceduti', 'tamponi'])
+
+    # Daily deltas and smoothed curves for all entities at once
+    derivati_regioni = Metrics(regioni, population.vector('regioni', regioni.names))
+    derivati_regioni.precompute(['totale_casi', 'deceduti', 'tamponi'])
+    derivati_province = Metrics(province, population.vector('province', province.names))
+    derivati_province.precompute(['totale_casi'])
+    derivati_nazione = Metrics(nazione, population.vector('nazione', nazione.names))
+    derivati_nazione.precompute(['totale_casi', 'deceduti', 'tamponi'])
+
+    # Nazione -> regioni -> province, e verifica che le somme delle
+    # province e delle regioni non superino i totali del livello sopra
+    gerarchia_regioni = Hierarchy(nazione, regioni, 'stato')
+    gerarchia_province = Hierarchy(regioni, province, 'codice_regione')
+    for gerarchia, derivati in [(gerarchia_regioni, derivati_regioni),
+                                (gerarchia_province, derivati_province)]:
+        for messaggio in gerarchia.check(derivati.filled('totale_casi'), 'totale_casi'):
+            print('Attenzione: %s' % messaggio)
+
+    # Matrices go to shared memory, so that workers map them instead
+    # of copying them, with any start method
+    for data in [regioni, province, derivati_regioni, derivati_province]:
+        data.share()
+
+    try:
+        os.makedirs(outdir)
+    except FileExistsError:
+        pass
+
+    # Images whose inputs did not change since the last run are not redrawn
+    plot_cache.load(outdir)
+
+    # Loading times go to the report of this site
+    builder.timer.merge(timer.take())
+
+def provincia_casi(provincia):
     p = CovidPlot('it', title=provincia, ymax=1e5)
     p.plot(*casi_provincia(provincia), label='Casi totali', **Styles.totalecasi)
     p.expfit(*casi_provincia(provincia), **Styles.expfit1)
-    html += p.save(os.path.join(outdir,'%s.png' % provincia))
+    return p.save(os.path.join(outdir,'%s.png' % provincia))
 
+def provincia_giornalieri(provincia):
     p = DailyPlot('it', title='%s - casi giornalieri' % provincia)
-    p.plot(*casi_provincia(provincia), label='Nuovi casi', **Styles.totalecasi)
-    html += p.save(os.path.join(outdir, '%s_giornalieri.png' % provincia))
+    p.plot_daily(*derivati_province.daily_series(provincia, 'totale_casi'), label='Nuovi casi', **Styles.totalecasi)
+    return p.save(os.path.join(outdir, '%s_giornalieri.png' % provincia))
 
+def provincia_casi_oo(provincia):
     p = OOPlot('it', title='%s - numero di casi' % provincia)
     _, totale_casi = casi_provincia(provincia)
     p.plot(totale_casi, smooth=False, **Styles.faintline)
-    p.plot(totale_casi)
-    html += p.save(os.path.join(outdir, '%s_casi_oo.png' % provincia))
-    return html
-
-def plot_regione(regione):
-    print(regione)
-    html = '<H2>%s</H2><a name="%s"></a>' % (regione, regione)
+    p.plot_curve(derivati_province.smoothed_series(provincia, 'totale_casi'))
+    return p.save(os.path.join(outdir, '%s_casi_oo.png' % provincia))
+
+# Grafici di ogni provincia, con il loro costo relativo (numero di serie)
+grafici_provincia = [(provincia_casi, 2),
+                     (provincia_giornalieri, 1),
+                     (provincia_casi_oo, 2)]
+
+# Gli stessi grafici per più province alla volta, ritagliati da una griglia
+def griglia_casi(province):
+    g = GridPlot(CovidPlot('it', ymax=1e5), province)
+    for provincia in province:
+        g.panel(provincia).plot(*casi_provincia(provincia), label='Casi totali', **Styles.totalecasi)
+        g.panel(provincia).expfit(*casi_provincia(provincia), **Styles.expfit1)
+    return g.save(crops=os.path.join(outdir, '%s.png'))
+
+def griglia_giornalieri(province):
+    g = GridPlot(DailyPlot('it'), province)
+    for provincia in province:
+        g.panel(provincia).plot_daily(*derivati_province.daily_series(provincia, 'totale_casi'),
+                                      label='Nuovi casi', **Styles.totalecasi)
+    return g.save(crops=os.path.join(outdir, '%s_giornalieri.png'))
+
+def griglia_casi_oo(province):
+    g = GridPlot(OOPlot('it'), province)
+    for provincia in province:
+        _, totale_casi = casi_provincia(provincia)
+        g.panel(provincia).plot(totale_casi, smooth=False, **Styles.faintline)
+        g.panel(provincia).plot_curve(derivati_province.smoothed_series(provincia, 'totale_casi'))
+    return g.save(crops=os.path.join(outdir, '%s_casi_oo.png'))
+
+if small_multiples:
+    grafici_provincia = [(griglia_casi, 2, small_multiples),
+                         (griglia_giornalieri, 1, small_multiples),
+                         (griglia_casi_oo, 2, small_multiples)]
+
+def regione_casi(regione):
     p = CovidPlot('it', title=regione)
     p.plot(*dati_regione(regione, 'totale_casi'), label='Casi totali', **Styles.totalecasi)
     p.plot(*dati_regione(regione, 'terapia_intensiva'), label='Terapia intensiva', **Styles.ti)
     p.plot(*dati_regione(regione, 'deceduti'), label='Deceduti', **Styles.deceduti)
     p.expfit(*dati_regione(regione, 'totale_casi'), **Styles.expfit1)
     p.expfit(*dati_regione(regione, 'deceduti'), **Styles.expfit2)
-    html += p.save(os.path.join(outdir,'%s.png' % regione))
+    return p.save(os.path.join(outdir,'%s.png' % regione))
 
+def regione_giornalieri(regione):
     p = DailyPlot('it', title='%s - casi giornalieri' % regione)
-    p.plot(*dati_regione(regione, 'totale_casi'), label='Nuovi casi', **Styles.totalecasi)
-    p.plot(*dati_regione(regione, 'deceduti'), label='Deceduti', **Styles.deceduti)
-    html += p.save(os.path.join(outdir, '%s_giornalieri.png' % regione))
+    p.plot_daily(*derivati_regioni.daily_series(regione, 'totale_casi'), label='Nuovi casi', **Styles.totalecasi)
+    p.plot_daily(*derivati_regioni.daily_series(regione, 'deceduti'), label='Deceduti', **Styles.deceduti)
+    return p.save(os.path.join(outdir, '%s_giornalieri.png' % regione))
 
+def regione_tamponi(regione):
     p = TestsPlot('it', title='%s - tamponi' % regione)
-    data, totale_casi = dati_regione(regione, 'totale_casi')
-    _, tamponi = dati_regione(regione, 'tamponi')
-    nuovi_casi = totale_casi[1:] - totale_casi[:-1]
-    nuovi_tamponi = tamponi[1:] - tamponi[:-1]
-    p.plot(data.to_numpy()[1:], nuovi_tamponi, label='Tamponi', width=0.40, color='gray')
-    p.plot(data.to_numpy()[1:], nuovi_casi, label='Nuovi casi', shift=0.40, width=0.40, color='red')
-    html += p.save(os.path.join(outdir, '%s_tamponi.png' % regione))
+    data, nuovi_casi = derivati_regioni.daily_series(regione, 'totale_casi')
+    _, nuovi_tamponi = derivati_regioni.daily_series(regione, 'tamponi')
+    p.plot(data.to_numpy(), nuovi_tamponi, label='Tamponi', width=0.40, color='gray')
+    p.plot(data.to_numpy(), nuovi_casi, label='Nuovi casi', shift=0.40, width=0.40, color='red')
+    return p.save(os.path.join(outdir, '%s_tamponi.png' % regione))
 
+def regione_casi_oo(regione):
     p = OOPlot('it', title='%s - numero di casi' % regione)
     _, totale_casi = dati_regione(regione, 'totale_casi')
     p.plot(totale_casi, smooth=False, **Styles.faintline)
-    p.plot(totale_casi)
-    html += p.save(os.path.join(outdir, '%s_casi_oo.png' % regione))
+    p.plot_curve(derivati_regioni.smoothed_series(regione, 'totale_casi'))
+    return p.save(os.path.join(outdir, '%s_casi_oo.png' % regione))
 
+def regione_deceduti_oo(regione):
     p = OOPlot('it', title='%s - decessi' % regione,
                xlabel='NumberOfDeaths',
                ylabel='NumberOfDailyDeaths')
     _, totale_casi = dati_regione(regione, 'deceduti')
     p.plot(totale_casi, smooth=False, **Styles.faintline)
-    p.plot(totale_casi)
-    html += p.save(os.path.join(outdir, '%s_deceduti_oo.png' % regione))
-    return html
-
-
-
-with open(os.path.join(outdir, 'index.html'), 'w') as f:
-    f.write('Ultimo aggiornamento: %s<br>' % last_update)
-    f.write('<H1>Dati nazionali</H1>\n')
-    p = CovidPlot('it', title='Italia')
-    p.plot(*dati_nazione('totale_casi'), label='Casi totali', **Styles.totalecasi)
-    p.plot(*dati_nazione('terapia_intensiva'), label='Terapia intensiva', **Styles.ti)
-    p.plot(*dati_nazione('deceduti'), label='Deceduti', **Styles.deceduti)
-    p.expfit(*dati_nazione('totale_casi'), **Styles.expfit1)
-    p.expfit(*dati_nazione('deceduti'), **Styles.expfit2)
-
-    t = Table(border=0, style='display: inline-block;')
-    f.write(
-      t.html( 
-        t.row( t.cell( p.save(os.path.join(outdir,'Italia.png')))),
-        t.row( t.cell( 'Fit esponenziale sugli ultimi 10 giorni', align='center'))))
-
-    p = CovidPlot('it', title='Italia - andamento')
-    p.plot(*dati_nazione('totale_casi'), label='Casi totali', **Styles.totalecasi)
-    p.plot(*dati_nazione('deceduti'), label='Deceduti', **Styles.deceduti)
-    p.expfit(*dati_nazione('totale_casi'), **Styles.expfit1)
-    p.expfit(*dati_nazione('totale_casi'), days_back=1, **Styles.expfit1a)
-    p.expfit(*dati_nazione('totale_casi'), days_back=2, **Styles.expfit1b)
-    p.expfit(*dati_nazione('totale_casi'), days_back=7, **Styles.expfit1b)
-
-    p.expfit(*dati_nazione('deceduti'), **Styles.expfit2)
-    p.expfit(*dati_nazione('deceduti'), days_back=1, **Styles.expfit2a)
-    p.expfit(*dati_nazione('deceduti'), days_back=2, **Styles.expfit2b)
-    p.expfit(*dati_nazione('deceduti'), days_back=7, **Styles.expfit2b)
-
-    t = Table(border=0, style='display: inline-block;')
-    f.write(
-      t.html( 
-        t.row( t.cell( p.save(os.path.join(outdir,'Italia_andamento.png')))),
-        t.row( t.cell( '''Fit esponenziale sugli ultimi 10 giorni, ripetuto
-                          per la data odierna, i due giorni precedenti e una settimana fa''', align='center'))))
-
-    p = DailyPlot('it', title='Italia - casi giornalieri')
-    p.plot(*dati_nazione('totale_casi'), label='Nuovi casi', **Styles.totalecasi)
-    p.plot(*dati_nazione('deceduti'), label='Deceduti', **Styles.deceduti)
-    f.write(p.save(os.path.join(outdir, 'Italia_giornalieri.png')))
-
-    p = TestsPlot('it', title='Italia - tamponi')
-    data, totale_casi = dati_nazione('totale_casi')
-    _, tamponi = dati_nazione('tamponi')
-    nuovi_casi = totale_casi[1:] - totale_casi[:-1]
-    nuovi_tamponi = tamponi[1:] - tamponi[:-1]
-    p.plot(data.to_numpy()[1:], nuovi_tamponi, label='Tamponi', width=0.40, color='gray')
-    p.plot(data.to_numpy()[1:], nuovi_casi, label='Nuovi casi', shift=0.40, width=0.40, color='red')
-    f.write(p.save(os.path.join(outdir, 'Italia_tamponi.png')))
-
-    p = OOPlot('it', title='Italia - numero di casi')
-    _, totale_casi = dati_nazione('totale_casi')
-    p.plot(totale_casi, smooth=False, **Styles.faintline)
-    p.plot(totale_casi)
-    f.write(p.save(os.path.join(outdir, 'Italia_casi_oo.png')))
-
-    p = OOPlot('it', title='Italia - decessi',
-                   xlabel='NumberOfDeaths',
-                   ylabel='NumberOfDailyDeaths')
-    _, totale_casi = dati_nazione('deceduti')
-    p.plot(totale_casi, smooth=False, **Styles.faintline)
-    p.plot(totale_casi)
-    f.write(p.save(os.path.join(outdir, 'Italia_deceduti_oo.png')))
-
-    with Pool(n_proc) as p:
-        html = p.map(plot_regione, sorted(lista_regioni()))
-
-    f.write('<H1>Dati regionali</H1>\n')
-    for regione in sorted(lista_regioni()):
-        f.write('<a href="#%s">%s</a> ' % (regione, regione))
-    f.write('\n')
-
-    f.write('\n'.join(html))
-
-
-    with Pool(n_proc) as p:
-        html = p.map(plot_provincia, sorted(lista_province()))
-
-    f.write('<H1>Dati provinciali</H1>\n')
-    for provincia in sorted(lista_province()):
-        f.write('<a href="#%s">%s</a> ' % (provincia, provincia))
-    f.write('\n')
-    f.write('\n'.join(html))
-
-    f.write(open('footer.html', 'r').read())
-
+    p.plot_curve(derivati_regioni.smoothed_series(regione, 'deceduti'))
+    return p.save(os.path.join(outdir, '%s_deceduti_oo.png' % regione))
+
+def regione_raddoppio(regione):
+    p = DoublingTimePlot('it', title='%s - tempo di raddoppio' % regione)
+    p.plot(*derivati_regioni.doubling_series(regione, 'totale_casi'), label='Casi totali', **Styles.totalecasi)
+    p.plot(*derivati_regioni.doubling_series(regione, 'deceduti'), label='Deceduti', **Styles.deceduti)
+    return p.save(os.path.join(outdir, '%s_raddoppio.png' % regione))
+
+# Grafici di ogni regione, con il loro costo relativo (numero di serie)
+grafici_regione = [(regione_casi, 5),
+                   (regione_giornalieri, 2),
+                   (regione_tamponi, 2),
+                   (regione_casi_oo, 2),
+                   (regione_deceduti_oo, 2),
+                   (regione_raddoppio, 2)]
+
+builder = PageBuilder(outdir)
+
+def worker_state():
+    # Globals used by the charts drawn in the workers
+    return (worker_state, {'regioni': regioni, 'province': province,
+                           'derivati_regioni': derivati_regioni,
+                           'derivati_province': derivati_province})
+
+def submit(scheduler):
+    builder.submit(scheduler, 'regioni', grafici_regione, sorted(lista_regioni()),
+                   regioni.digests())
+    builder.submit(scheduler, 'province', grafici_provincia, sorted(lista_province()),
+                   province.digests(), regione_di)
+
+def link_province(regione):
+    link = ' '.join('<a href="index.html#%s">%s</a>' % (provincia, provincia)
+                    for provincia in sorted(province_di(regione)))
+    return '<p>%s: %s</p>\n' % (regione, link) if link else ''
+
+def write_index(last_update):
+
+    # Data for viewer.html, written while the workers draw
+    export.write(outdir, 'regioni', regioni, derivati_regioni,
+                 ['totale_casi', 'terapia_intensiva', 'deceduti'])
+    export.write(outdir, 'province', province, derivati_province, ['totale_casi'])
+
+    # National plots are drawn here while the workers are busy
+    with builder.index() as f:
+        f.write('Ultimo aggiornamento: %s<br>' % last_update)
+        f.write('<a href="regioni_summary.html">Riepilogo regioni</a> '
+                '<a href="province_summary.html">Riepilogo province</a><br>')
+        f.write('<H1>Dati nazionali</H1>\n')
+        p = CovidPlot('it', title='Italia')
+        p.plot(*dati_nazione('totale_casi'), label='Casi totali', **Styles.totalecasi)
+        p.plot(*dati_nazione('terapia_intensiva'), label='Terapia intensiva', **Styles.ti)
+        p.plot(*dati_nazione('deceduti'), label='Deceduti', **Styles.deceduti)
+        p.expfit(*dati_nazione('totale_casi'), **Styles.expfit1)
+        p.expfit(*dati_nazione('deceduti'), **Styles.expfit2)
+
+        t = Table(border=0, style='display: inline-block;')
+        f.write(
+          t.html( 
+            t.row( t.cell( p.save(os.path.join(outdir,'Italia.png')))),
+            t.row( t.cell( 'Fit esponenziale sugli ultimi 10 giorni', align='center'))))
+
+        p = CovidPlot('it', title='Italia - andamento')
+        p.plot(*dati_nazione('totale_casi'), label='Casi totali', **Styles.totalecasi)
+        p.plot(*dati_nazione('deceduti'), label='Deceduti', **Styles.deceduti)
+        p.expfit(*dati_nazione('totale_casi'), **Styles.expfit1)
+        p.expfit(*dati_nazione('totale_casi'), days_back=1, **Styles.expfit1a)
+        p.expfit(*dati_nazione('totale_casi'), days_back=2, **Styles.expfit1b)
+        p.expfit(*dati_nazione('totale_casi'), days_back=7, **Styles.expfit1b)
+
+        p.expfit(*dati_nazione('deceduti'), **Styles.expfit2)
+        p.expfit(*dati_nazione('deceduti'), days_back=1, **Styles.expfit2a)
+        p.expfit(*dati_nazione('deceduti'), days_back=2, **Styles.expfit2b)
+        p.expfit(*dati_nazione('deceduti'), days_back=7, **Styles.expfit2b)
+
+        t = Table(border=0, style='display: inline-block;')
+        f.write(
+          t.html( 
+            t.row( t.cell( p.save(os.path.join(outdir,'Italia_andamento.png')))),
+            t.row( t.cell( '''Fit esponenziale sugli ultimi 10 giorni, ripetuto
+                              per la data odierna, i due giorni precedenti e una settimana fa''', align='center'))))
+
+        p = DailyPlot('it', title='Italia - casi giornalieri')
+        p.plot_daily(*derivati_nazione.daily_series('ITA', 'totale_casi'), label='Nuovi casi', **Styles.totalecasi)
+        p.plot_daily(*derivati_nazione.daily_series('ITA', 'deceduti'), label='Deceduti', **Styles.deceduti)
+        f.write(p.save(os.path.join(outdir, 'Italia_giornalieri.png')))
+
+        p = TestsPlot('it', title='Italia - tamponi')
+        data, nuovi_casi = derivati_nazione.daily_series('ITA', 'totale_casi')
+        _, nuovi_tamponi = derivati_nazione.daily_series('ITA', 'tamponi')
+        p.plot(data.to_numpy(), nuovi_tamponi, label='Tamponi', width=0.40, color='gray')
+        p.plot(data.to_numpy(), nuovi_casi, label='Nuovi casi', shift=0.40, width=0.40, color='red')
+        f.write(p.save(os.path.join(outdir, 'Italia_tamponi.png')))
+
+        p = OOPlot('it', title='Italia - numero di casi')
+        _, totale_casi = dati_nazione('totale_casi')
+        p.plot(totale_casi, smooth=False, **Styles.faintline)
+        p.plot_curve(derivati_nazione.smoothed_series('ITA', 'totale_casi'))
+        f.write(p.save(os.path.join(outdir, 'Italia_casi_oo.png')))
+
+        p = OOPlot('it', title='Italia - decessi',
+                       xlabel='NumberOfDeaths',
+                       ylabel='NumberOfDailyDeaths')
+        _, totale_casi = dati_nazione('deceduti')
+        p.plot(totale_casi, smooth=False, **Styles.faintline)
+        p.plot_curve(derivati_nazione.smoothed_series('ITA', 'deceduti'))
+        f.write(p.save(os.path.join(outdir, 'Italia_deceduti_oo.png')))
+
+        p = DoublingTimePlot('it', title='Italia - tempo di raddoppio')
+        p.plot(*derivati_nazione.doubling_series('ITA', 'totale_casi'), label='Casi totali', **Styles.totalecasi)
+        p.plot(*derivati_nazione.doubling_series('ITA', 'deceduti'), label='Deceduti', **Styles.deceduti)
+        f.write(p.save(os.path.join(outdir, 'Italia_raddoppio.png')))
+
+        f.write('<H1>Dati regionali</H1>\n')
+        for regione in sorted(lista_regioni()):
+            f.write('<a href="#%s">%s</a> ' % (regione, regione))
+        f.write('\n')
+
+        builder.write_section(f, 'regioni', sorted(lista_regioni()), link_province)
+
+        f.write('<H1>Dati provinciali</H1>\n')
+        for regione in sorted(lista_regioni()):
+            f.write(link_province(regione))
+        for provincia in sorted(lista_province()):
+            if regione_di(provincia) is None:
+                f.write('<a href="#%s">%s</a> ' % (provincia, provincia))
+        f.write('\n')
+        builder.write_section(f, 'province', sorted(lista_province()))
+
+        f.write(open('footer.html', 'r').read())
+
+    summary.write(builder, outdir, 'regioni', derivati_regioni, [('totale_casi', 'Casi'), ('deceduti', 'Deceduti')],
+                  'Regione', lang='it', title='Regioni')
+    summary.write(builder, outdir, 'province', derivati_province, [('totale_casi', 'Casi')],
+                  'Provincia', lang='it', title='Province')
+
+    builder.write_report()
+
+
+if __name__ == '__main__':
+    last_update = sys.argv[1]
+    check_settings()
+    load()
+    scheduler = Scheduler()
+    submit(scheduler)
+    with shared.pool(n_proc, [worker_state()]) as pool:
+        scheduler.start(pool)
+        write_index(last_update)
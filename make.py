@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+# Builds the Italian, US and world pages in a single process.
+# All data is loaded once and shared with the workers, and the charts of the
+# three sites are scheduled together, longest first, so that the
+# workers are kept busy across the whole build.
+#
+# Usage: make.py <italian data update> <world data update>
+
+import sys
+import pages
+import shared
+from scheduler import Scheduler
+
+import italia
+import us
+import row
+
+
+if __name__ == '__main__':
+    last_update_italia, last_update_world = sys.argv[1:3]
+    pages.check_settings()
+
+    sites = [(italia, last_update_italia),
+             (us, last_update_world),
+             (row, last_update_world)]
+
+    for site, _ in sites:
+        site.load()
+
+    scheduler = Scheduler()
+    for site, _ in sites:
+        site.submit(scheduler)
+
+    n_proc = max(site.n_proc for site, _ in sites)
+    states = [site.worker_state() for site, _ in sites]
+    with shared.pool(n_proc, states) as pool:
+        scheduler.start(pool)
+        for site, last_update in sites:
+            site.write_index(last_update)
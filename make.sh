@@ -9,7 +9,5 @@ git pull
 B="`git log -1 --format="%at" | xargs -I{}  date -d @{} "+%Y-%m-%d %H:%M:%S" --utc` UTC"
 
 cd ../covid_plots
-python italia.py "$A"
-python us.py "$B"
-python row.py "$B"
+python make.py "$A" "$B"
 
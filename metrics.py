@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+
+import shared
+from fitting import rolling_expfit, doubling_time, min_growth
+from timing import timer
+
+
+class Metrics():
+
+    # Derived series (daily deltas, rolling means, smoothed curves,
+    # positivity) computed once over the whole entity x date matrices
+    # of a Dataset and cached. Plots only read one row at a time.
+    # population, if given, holds the population of each entity (see
+    # population.vector()), for the per-capita values.
+
+    def __init__(self, dataset, population=None):
+        self.dataset = dataset
+        self.population = population
+        self.cache = {}
+
+    def cached(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def precompute(self, columns, wsize=15, order=3):
+
+        # Called before the Pool is created, so that workers receive
+        # the results instead of computing them once each
+        for column in columns:
+            self.daily(column)
+            self.smoothed(column, wsize, order)
+            self.doubling_time(column)
+
+    def share(self):
+
+        # Moves the cached matrices to shared memory, see Dataset.share().
+        # Values are arrays or tuples of arrays (see smoothed()).
+        for key, value in self.cache.items():
+            if isinstance(value, tuple):
+                self.cache[key] = tuple(shared.publish(v) for v in value)
+            elif isinstance(value, np.ndarray):
+                self.cache[key] = shared.publish(value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = {key: tuple(map(shared.reference, value)) if isinstance(value, tuple)
+                          else shared.reference(value) for key, value in self.cache.items()}
+        return state
+
+    def __setstate__(self, state):
+        state['cache'] = {key: tuple(map(shared.attach, value)) if isinstance(value, tuple)
+                          else shared.attach(value) for key, value in state['cache'].items()}
+        self.__dict__.update(state)
+
+    def filled(self, column):
+
+        # Values of missing dates are carried forward from the
+        # previous date present for the same entity
+        def compute():
+            m = self.dataset.columns[column]
+            idx = np.where(self.dataset.present, np.arange(m.shape[1]), 0)
+            np.maximum.accumulate(idx, axis=1, out=idx)
+            return np.take_along_axis(m, idx, axis=1)
+
+        return self.cached(('filled', column), compute)
+
+    def daily(self, column):
+
+        # Difference from the previous date present, 0 for the first date
+        def compute():
+            m = self.filled(column)
+            daily = np.zeros_like(m)
+            daily[:, 1:] = m[:, 1:] - m[:, :-1]
+            return daily
+
+        return self.cached(('daily', column), compute)
+
+    def rolling(self, column, n=7):
+
+        # n-day mean of the daily deltas, NaN for the first n-1 dates
+        def compute():
+            daily = self.daily(column).astype(np.float64)
+            cumsum = np.zeros((daily.shape[0], daily.shape[1]+1))
+            np.cumsum(daily, axis=1, out=cumsum[:, 1:])
+            mean = np.full(daily.shape, np.nan)
+            mean[:, n-1:] = (cumsum[:, n:] - cumsum[:, :-n]) / float(n)
+            return mean
+
+        return self.cached(('rolling', column, n), compute)
+
+    def positivity(self, cases='totale_casi', tests='tamponi'):
+
+        # Fraction of new tests that found a new case
+        def compute():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = self.daily(cases) / self.daily(tests)
+            ratio[self.daily(tests) <= 0] = np.nan
+            return ratio
+
+        return self.cached(('positivity', cases, tests), compute)
+
+    def per_100k(self, column):
+
+        # Values per 100k inhabitants, NaN where the population is unknown
+        return self.cached(('per_100k', column),
+                           lambda: self.filled(column) * (1e5 / self.population)[:, np.newaxis])
+
+    def new_per_100k(self, column, n=7):
+
+        # New values of the last n days per 100k inhabitants
+        return self.cached(('new_per_100k', column, n),
+                           lambda: self.rolling(column, n) * (n * 1e5 / self.population)[:, np.newaxis])
+
+    def growth(self, column, npoints=10):
+
+        # Rate of the exponential fit over the npoints dates present up
+        # to each date, as CovidPlot.expfit() computes for the last date
+        # only. Rows with all dates present are fitted together, the
+        # others one by one on their present dates, so that the values
+        # carried forward by filled() are never fitted.
+        def compute():
+            with timer.stage('fit'):
+                days = self.dataset.dates.values.astype('datetime64[D]').astype(np.float64)
+                m = self.filled(column)
+                present = self.dataset.present
+                full = present.all(axis=1)
+                a = np.full(m.shape, np.nan)
+                a[full], _ = rolling_expfit(days, m[full], npoints)
+                for i in np.flatnonzero(~full):
+                    mask = present[i]
+                    a[i, mask] = rolling_expfit(days[mask], m[i, mask], npoints)[0][0]
+            return a
+
+        return self.cached(('growth', column, npoints), compute)
+
+    def doubling_time(self, column, npoints=10):
+        return self.cached(('doubling_time', column, npoints),
+                           lambda: doubling_time(self.growth(column, npoints), min_growth))
+
+    def smoothed(self, column, wsize=15, order=3):
+
+        # Savitzky-Golay filter of the log of the series, restricted to
+        # the values >= 10, as plotted by OOPlot. Returns a matrix with
+        # the curve of each entity at the start of its row, padded with
+        # NaN, and the length of each curve, 0 where the series is too
+        # short to be smoothed. Rows with the same number of values are
+        # filtered together.
+        def compute():
+            from scipy.signal import savgol_filter
+            with timer.stage('smooth'):
+                m = self.dataset.columns[column]
+                keep = self.dataset.present & (m >= 10)
+                lengths = keep.sum(axis=1)
+                lengths[lengths < wsize+2] = 0
+                curves = np.full((len(m), lengths.max(initial=0)), np.nan)
+                for length in np.unique(lengths[lengths > 0]):
+                    rows = np.flatnonzero(lengths == length)
+                    block = m[rows][keep[rows]].reshape(len(rows), length)
+                    curves[rows, :length] = np.exp(savgol_filter(np.log(block), wsize, order, axis=1))
+                return curves, lengths
+
+        return self.cached(('smoothed', column, wsize, order), compute)
+
+    def daily_series(self, name, column):
+
+        # Same dates and values as DailyPlot computes from dataset.series()
+        i = self.dataset.index[name]
+        mask = self.dataset.present[i].copy()
+        mask[np.argmax(mask)] = False
+        return (pd.Series(self.dataset.dates[mask]), self.daily(column)[i, mask])
+
+    def rolling_series(self, name, column, n=7):
+        i = self.dataset.index[name]
+        mask = self.dataset.present[i]
+        return (pd.Series(self.dataset.dates[mask]), self.rolling(column, n)[i, mask])
+
+    def doubling_series(self, name, column, npoints=10):
+        i = self.dataset.index[name]
+        mask = self.dataset.present[i]
+        return (pd.Series(self.dataset.dates[mask]), self.doubling_time(column, npoints)[i, mask])
+
+    def smoothed_series(self, name, column, wsize=15, order=3):
+
+        # Smoothed curve of one entity, None if it is too short
+        curves, lengths = self.smoothed(column, wsize, order)
+        i = self.dataset.index[name]
+        return curves[i, :lengths[i]] if lengths[i] else None
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import cProfile
+from urllib.parse import quote
+
+from settings import setting
+from timing import Timer, timer
+
+# Number of slowest entities whose cProfile dump is kept in
+# <outdir>/profiles. Every entity is profiled when this is not 0.
+profile_slowest = setting('profile_slowest', 0)
+
+# When True, the index shows only the first chart of each entity, and
+# links to a page <outdir>/<section>_<name>.html with all of them
+subpages = setting('subpages', False)
+
+# When True, entities whose data did not change since the last run are
+# not drawn again, and the index is assembled from their old fragments
+incremental = setting('incremental', False)
+
+# When False, charts are not drawn and each entity links to its charts
+# in viewer.html, drawn in the browser from the data export.py writes
+# (which json_export = False does not turn off)
+server_charts = setting('server_charts', True)
+
+# When not 0, the sites draw the small charts of up to this many entities
+# in one figure (see GridPlot), cut into the image of each entity. The
+# crops are PNG without thumbnails, so other image formats or a
+# thumbnail_dpi fall back to one figure per chart (see check_settings).
+grids = setting('image_format', 'png') == 'png' and not setting('thumbnail_dpi', None)
+small_multiples = setting('small_multiples', 0) if grids else 0
+
+
+def check_settings():
+
+    # Warns about the settings that are ignored. Called once by the
+    # script that builds the pages, not on import, which every worker
+    # repeats.
+    if setting('small_multiples', 0) and not small_multiples:
+        print('Warning: small_multiples needs image_format = \'png\' and no thumbnail_dpi, ignored')
+
+def sources(modules):
+
+    # Hash of the source files of the given modules
+    digest = hashlib.sha1()
+    for module in modules:
+        with open(sys.modules[module].__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def build(chart, name, filename, entity, profile_filename, first):
+
+    # Runs in the workers: draws one chart and writes its html to filename.
+    # The encoder threads write its images while the rest of the chart is
+    # drawn (see covid.run()), and the task ends once they are on disk, so
+    # that their errors fail this task.
+    from covid import flush
+    if first:
+        print(name)
+    profile = cProfile.Profile() if profile_filename else None
+    with timer.entity(entity):
+        if profile:
+            profile.enable()
+        html = chart(name)
+        if profile:
+            profile.disable()
+        flush()
+        with timer.stage('html'):
+            with open(filename + '.tmp', 'w') as f:
+                f.write(html)
+            os.replace(filename + '.tmp', filename)
+    if profile:
+        profile.dump_stats(profile_filename)
+    return timer.take()
+
+def build_grid(chart, names, filenames, entities, first):
+
+    # As build(), for a chart drawing several entities at once: chart(names)
+    # returns the html of each of them, written to filenames
+    from covid import flush
+    if first:
+        print(', '.join(names))
+    with timer.entity(entities[0]):
+        html = chart(names)
+        flush()
+        with timer.stage('html'):
+            for filename, h in zip(filenames, html):
+                with open(filename + '.tmp', 'w') as f:
+                    f.write(h)
+                os.replace(filename + '.tmp', filename)
+    timer.split(entities[0], entities)
+    return timer.take()
+
+def ranking_table(headers, rows, link='index.html#%s', sortable=False):
+
+    # Table of rows of a name followed by numbers, as summary.py builds
+    # them, the name of each entity linking to its charts. A sortable table keeps the value
+    # of each number for the script of summary.py, NaN shown as '-'.
+    html = '<table border=1%s>\n<tr>%s</tr>\n' % (' class="sortable"' if sortable else '',
+                                                   ''.join('<th>%s</th>' % h for h in ['#'] + headers))
+    for rank, (name, *values) in enumerate(rows, 1):
+        cells = ['<td data-v="%d">%d</td>' % (rank, rank) if sortable else '<td>%d</td>' % rank,
+                 '<td><a href="%s">%s</a></td>' % (quote(link % name, safe='/#.'), name)]
+        for v in values:
+            text = '%d' % v if isinstance(v, int) else '-' if v != v else '%.1f' % v
+            cells.append('<td data-v="%s">%s</td>' % ('' if v != v else v, text) if sortable else
+                         '<td>%s</td>' % text)
+        html += '<tr>%s</tr>\n' % ''.join(cells)
+    return html + '</table>\n'
+
+
+class PageBuilder():
+
+    # Each chart of each entity is a separate task (see Scheduler). The
+    # worker that draws it writes its html to
+    # <outdir>/fragments/<section>/<name>.<n>.html as soon as it is ready.
+    # Index pages are then assembled by copying the fragments in sorted
+    # order, so the parent never holds all of them in memory, and a run
+    # that stops half way still leaves the finished fragments on disk.
+    #
+    # Stage and entity timings of the workers are returned with each
+    # fragment and collected in self.timer, and written to
+    # <outdir>/report.json by write_report(). The entity timings of the
+    # previous report are used to schedule the slowest charts first.
+    #
+    # The digest of the data of each entity is saved with its fragments
+    # in <outdir>/fragments/<section>/snapshot.json, see incremental.
+    # The workers print the name of each entity they start, unless quiet.
+
+    def __init__(self, outdir, quiet=False):
+        self.outdir = outdir
+        self.quiet = quiet
+        self.dirname = os.path.join(outdir, 'fragments')
+        self.profiles = os.path.join(outdir, 'profiles')
+        self.timer = Timer()
+        self.parts = {}
+        self.snapshots = {}
+        self.scheduler = None
+
+    @staticmethod
+    def header(name, link=None):
+        if link is not None:
+            return '<H2><a href="%s">%s</a></H2><a name="%s"></a>' % (quote(link, safe='/?=#'), name, name)
+        return '<H2>%s</H2><a name="%s"></a>' % (name, name)
+
+    def subpage(self, section, name):
+        return '%s_%s.html' % (section, name)
+
+    def fragment(self, section, name, part):
+        return os.path.join(self.dirname, section, '%s.%d.html' % (name, part))
+
+    def profile(self, section, name, part):
+        return os.path.join(self.profiles, '%s_%s.%d.prof' % (section, name, part))
+
+    def snapshot(self, section):
+        return os.path.join(self.dirname, section, 'snapshot.json')
+
+    def previous(self, section):
+
+        # Digests saved by the last complete run of section
+        try:
+            with open(self.snapshot(section)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def history(self):
+
+        # Wall time of each entity in the previous run
+        try:
+            with open(os.path.join(self.outdir, 'report.json')) as f:
+                return {e['name']: e['wall'] for e in json.load(f)['entities']}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def submit(self, scheduler, section, charts, names, digests=None, group=None):
+
+        # charts is a list of (func, weight), where func(name) returns the
+        # html of one chart and weight is its expected relative cost (e.g.
+        # the number of series drawn). Without a previous run, costs are
+        # estimated from the weights alone. digests (see Dataset.digests())
+        # tells which entities changed, for the incremental mode.
+        #
+        # A chart can also be (func, weight, size), where func(names) draws
+        # up to size entities at once (see GridPlot) and returns the html
+        # of each. Entities are grouped in the given order, within the
+        # groups of group(name) if given (e.g. the region of a province),
+        # and a group is drawn again when any of its entities changed.
+        os.makedirs(os.path.join(self.dirname, section), exist_ok=True)
+        if profile_slowest:
+            os.makedirs(self.profiles, exist_ok=True)
+
+        self.scheduler = scheduler
+        self.parts[section] = len(charts)
+        if not server_charts:
+            return
+        total = sum(chart[1] for chart in charts)
+        history = self.history()
+        per_weight = sum(history.values()) / total / len(history) if history else 1.0
+
+        # The source of the code that draws (the plots, the metrics, the
+        # fits and the script of the charts) and the image settings are
+        # part of each digest, so that all entities are drawn again when
+        # they change
+        snapshot = {}
+        if digests is not None:
+            from covid import renderer, image_format, thumbnail_dpi, png_compress_level
+            code = hashlib.sha1(repr((renderer, image_format, thumbnail_dpi, png_compress_level)).encode())
+            modules = ['covid', 'dataset', 'metrics', 'fitting']
+            modules += sorted({chart.__module__ for chart, *_ in charts})
+            code.update(sources(modules).encode())
+            for chart, *_ in charts:
+                code.update(chart.__qualname__.encode())
+            for name in names:
+                snapshot[name] = hashlib.sha1((code.hexdigest() + digests[name]).encode()).hexdigest()
+        self.snapshots[section] = snapshot
+        previous = self.previous(section) if incremental else {}
+
+        changed = []
+        for name in names:
+            if name in previous and previous[name] == snapshot.get(name) and \
+               all(os.path.exists(self.fragment(section, name, part)) for part in range(len(charts))):
+                continue
+            changed.append(name)
+        wall = {name: history.get('%s/%s' % (section, name), per_weight * total) for name in names}
+        for part, (chart, weight, *size) in enumerate(charts):
+            if size:
+                changed_set = set(changed)
+                members = {}
+                for name in names:
+                    members.setdefault(group(name) if group else None, []).append(name)
+                chunks = [m[i:i+size[0]] for m in members.values() for i in range(0, len(m), size[0])]
+                for chunk in chunks:
+                    if changed_set.isdisjoint(chunk):
+                        continue
+                    scheduler.add((self.outdir, section), sum(wall[name] for name in chunk) * weight / total,
+                                  build_grid, chart, chunk,
+                                  [self.fragment(section, name, part) for name in chunk],
+                                  ['%s/%s' % (section, name) for name in chunk],
+                                  part == 0 and not self.quiet)
+                continue
+            for name in changed:
+                profile = self.profile(section, name, part) if profile_slowest else None
+                scheduler.add((self.outdir, section), wall[name] * weight / total,
+                              build, chart, name, self.fragment(section, name, part),
+                              '%s/%s' % (section, name), profile, part == 0 and not self.quiet)
+        if incremental:
+            print('%s: %d of %d unchanged' % (section, len(names) - len(changed), len(names)))
+
+    def write_section(self, f, section, names, extra=None):
+
+        # Waits for the workers, then streams the fragments into f.
+        # extra(name), if given, returns html written after the charts of
+        # each entity, also on its subpage.
+        for taken in self.scheduler.wait((self.outdir, section)):
+            self.timer.merge(taken)
+        with open(self.snapshot(section) + '.tmp', 'w') as snapshot:
+            json.dump(self.snapshots.get(section, {}), snapshot)
+        os.replace(self.snapshot(section) + '.tmp', self.snapshot(section))
+        with timer.stage('html'):
+            for i, name in enumerate(names):
+                if i > 0:
+                    f.write('\n')
+                if not server_charts:
+                    f.write(self.header(name, 'viewer.html?section=%s#%s' % (section, name)))
+                    if extra is not None:
+                        f.write(extra(name))
+                    continue
+                if subpages:
+                    self.write_subpage(section, name, extra)
+                    f.write(self.header(name, self.subpage(section, name)))
+                    parts = 1
+                else:
+                    f.write(self.header(name))
+                    parts = self.parts[section]
+                for part in range(parts):
+                    self.copy_fragment(f, section, name, part)
+                if extra is not None:
+                    f.write(extra(name))
+
+    def copy_fragment(self, f, section, name, part):
+        with open(self.fragment(section, name, part)) as fragment:
+            shutil.copyfileobj(fragment, f)
+
+    def write_subpage(self, section, name, extra=None):
+        with IndexFile(os.path.join(self.outdir, self.subpage(section, name))) as f:
+            f.write('<a href="index.html#%s">Index</a>\n' % quote(name))
+            f.write(self.header(name))
+            for part in range(self.parts[section]):
+                self.copy_fragment(f, section, name, part)
+            if extra is not None:
+                f.write(extra(name))
+
+    def write_report(self):
+
+        # Adds what this process did since the last call, and keeps
+        # only the profiles of the slowest entities
+        self.timer.merge(timer.take())
+        self.timer.report(os.path.join(self.outdir, 'report.json'))
+        if profile_slowest:
+            keep = self.timer.slowest(profile_slowest)
+            for entity in self.timer.entities:
+                if entity not in keep:
+                    section, name = entity.split('/', 1)
+                    for part in range(self.parts.get(section, 0)):
+                        try:
+                            os.remove(self.profile(section, name, part))
+                        except FileNotFoundError:
+                            pass
+
+    def index(self, filename='index.html'):
+
+        # The index is written under a temporary name and replaces the
+        # previous one only when complete, and the images drawn by this
+        # process are written. Those of the workers are written before
+        # their tasks end.
+        from covid import flush
+        return IndexFile(os.path.join(self.outdir, filename), flush)
+
+
+class IndexFile():
+
+    def __init__(self, filename, before=None):
+        self.filename = filename
+        self.before = before
+
+    def __enter__(self):
+        self.f = open(self.filename + '.tmp', 'w')
+        return self.f
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        if exc_type is None and self.before is not None:
+            self.before()
+        if exc_type is None:
+            os.replace(self.filename + '.tmp', self.filename)
+        else:
+            os.remove(self.filename + '.tmp')
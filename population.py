@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+# Population of the entities of each section (nations, states, regioni,
+# province, and nazione for the national totals), from population.csv.
+# Figures are official estimates for 2019-2020 (ISTAT, US Census
+# Bureau, UN), rounded to the thousand for provinces and nations. The
+# table is read once per process, and joined to a Dataset as a vector
+# aligned with its entities, so that per-capita values are a single
+# broadcast over the entity x date matrices.
+
+import os
+import csv
+import numpy as np
+
+table = None
+
+
+def load():
+    global table
+    if table is None:
+        table = {}
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'population.csv')
+        with open(filename, newline='') as f:
+            for row in csv.DictReader(f):
+                table.setdefault(row['section'], {})[row['name']] = int(row['population'])
+    return table
+
+def vector(section, names):
+
+    # Population of each of names, NaN where it is not known
+    populations = load().get(section, {})
+    return np.array([populations.get(name, np.nan) for name in names], dtype=np.float64)
+
+
+if __name__ == '__main__':
+    for section, populations in sorted(load().items()):
+        print('%-10s %4d entities, %14d inhabitants' % (section, len(populations), sum(populations.values())))
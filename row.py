@@ -2,10 +2,17 @@
 
 import sys
 import os.path
-import pandas as pd
-from multiprocessing import Pool
 
-from covid import i18n, Styles, CovidPlot, DailyPlot, OOPlot
+from covid import i18n, Styles, CovidPlot, DailyPlot, DoublingTimePlot, GridPlot, OOPlot, plot_cache
+from dataset import Dataset
+from metrics import Metrics
+from pages import PageBuilder, check_settings, small_multiples
+from scheduler import Scheduler
+import export
+import population
+import summary
+import shared
+from timing import timer
 
 try:
     from my_config_row import csv_dir, outdir, n_proc
@@ -14,71 +21,166 @@ except ModuleNotFoundError:
     csv_dir = '../COVID-19-world/csse_covid_19_data/csse_covid_19_time_series'
     homedir = os.getenv('HOME')
     outdir = os.path.join(homedir, 'public_html/coronavirus/world')
-    n_proc = 1
+    n_proc = os.cpu_count()
 
 csv_confirmed = os.path.join(csv_dir, 'time_series_covid19_confirmed_global.csv')
 csv_deaths    = os.path.join(csv_dir, 'time_series_covid19_deaths_global.csv')
 
-last_update = sys.argv[1]
-
 def nations_list():
+    return world.names
 
-    a = pd.read_csv(csv_confirmed)
-    b = a.groupby('Country/Region').sum().reset_index()
-    return b.to_numpy()[:,0]
+def extract(column, nation):
+    return world.series(nation, column)
 
-def extract(csv_filename, nation):
+def load():
+    global world, world_metrics
 
-    a = pd.read_csv(csv_filename)
-    b = a.groupby('Country/Region').sum().reset_index()
-    data = b.loc[ b['Country/Region'] == nation].to_numpy()
-    return (pd.to_datetime(a.columns[4:].to_series()), data[:,3:].astype('int64').flatten())
+    # Both files are parsed once here, before the Pool is created, and
+    # moved to shared memory so that the workers map the matrices
+    # instead of copying them.
+    world = Dataset.from_wide_csv({'Confirmed': csv_confirmed, 'Deaths': csv_deaths},
+                                  'Country/Region')
+    world_metrics = Metrics(world, population.vector('nations', world.names))
+    world_metrics.precompute(['Confirmed', 'Deaths'])
+    world.share()
+    world_metrics.share()
 
-try:
-    os.makedirs(outdir)
-except FileExistsError:
-    pass
+    try:
+        os.makedirs(outdir)
+    except FileExistsError:
+        pass
+
+    # Images whose inputs did not change since the last run are not redrawn
+    plot_cache.load(outdir)
 
-def plot_nation(nation):
+    # Loading times go to the report of this site
+    builder.timer.merge(timer.take())
 
-    print(nation)
-    html = '<H2>%s</H2><a name="%s"></a>' % (nation, nation)
+def nation_cases(nation):
     p = CovidPlot('it', title=nation)
-    p.plot(*extract(csv_confirmed, nation), label='Total cases', **Styles.totalecasi)
-    p.plot(*extract(csv_deaths, nation), label='Deaths', **Styles.deceduti)
-    p.expfit(*extract(csv_confirmed, nation), **Styles.expfit1)
-    p.expfit(*extract(csv_deaths, nation), **Styles.expfit2)
-    html += p.save(os.path.join(outdir,'%s.png' % nation))
+    p.plot(*extract('Confirmed', nation), label='Total cases', **Styles.totalecasi)
+    p.plot(*extract('Deaths', nation), label='Deaths', **Styles.deceduti)
+    p.expfit(*extract('Confirmed', nation), **Styles.expfit1)
+    p.expfit(*extract('Deaths', nation), **Styles.expfit2)
+    return p.save(os.path.join(outdir,'%s.png' % nation))
 
+def nation_daily(nation):
     p = DailyPlot('en', title='%s - daily cases' % nation)
-    p.plot(*extract(csv_confirmed, nation), label='New cases', **Styles.totalecasi)
-    p.plot(*extract(csv_deaths, nation), label='Deaths', **Styles.deceduti)
-    html += p.save(os.path.join(outdir, '%s_daily.png' % nation))
+    p.plot_daily(*world_metrics.daily_series(nation, 'Confirmed'), label='New cases', **Styles.totalecasi)
+    p.plot_daily(*world_metrics.daily_series(nation, 'Deaths'), label='Deaths', **Styles.deceduti)
+    return p.save(os.path.join(outdir, '%s_daily.png' % nation))
 
+def nation_cases_oo(nation):
     p = OOPlot('en', title='%s - Cases' % nation)
-    _, cases = extract(csv_confirmed, nation)
+    _, cases = extract('Confirmed', nation)
     p.plot(cases, smooth=False, **Styles.faintline)
-    p.plot(cases)
-    html += p.save(os.path.join(outdir, '%s_cases_oo.png' % nation))
+    p.plot_curve(world_metrics.smoothed_series(nation, 'Confirmed'))
+    return p.save(os.path.join(outdir, '%s_cases_oo.png' % nation))
 
+def nation_deaths_oo(nation):
     p = OOPlot('en', title='%s - Deaths' % nation,
                xlabel='NumberOfDeaths',
                ylabel='NumberOfDailyDeaths')
-    _, cases = extract(csv_deaths, nation)
+    _, cases = extract('Deaths', nation)
     p.plot(cases, smooth=False, **Styles.faintline)
-    p.plot(cases)
-    html += p.save(os.path.join(outdir, '%s_deaths_oo.png' % nation))
-    return html
-
-with open(os.path.join(outdir, 'index.html'), 'w') as f:
-    f.write('Last update: %s<br>' % last_update)
-
-    for nation in sorted(nations_list()):
-        f.write('<a href="#%s">%s</a> ' % (nation, nation))
-
-    with Pool(n_proc) as p:
-        html = p.map(plot_nation, sorted(nations_list()))
-
-    f.write('\n'.join(html))
-
-
+    p.plot_curve(world_metrics.smoothed_series(nation, 'Deaths'))
+    return p.save(os.path.join(outdir, '%s_deaths_oo.png' % nation))
+
+def nation_doubling(nation):
+    p = DoublingTimePlot('en', title='%s - doubling time' % nation)
+    p.plot(*world_metrics.doubling_series(nation, 'Confirmed'), label='Cases', **Styles.totalecasi)
+    p.plot(*world_metrics.doubling_series(nation, 'Deaths'), label='Deaths', **Styles.deceduti)
+    return p.save(os.path.join(outdir, '%s_doubling.png' % nation))
+
+# Charts of each nation, with their relative cost (number of series)
+nation_charts = [(nation_cases, 4),
+                 (nation_daily, 2),
+                 (nation_cases_oo, 2),
+                 (nation_deaths_oo, 2),
+                 (nation_doubling, 2)]
+
+# The same charts for several nations at once, cut out of one grid
+def nations_cases(nations):
+    g = GridPlot(CovidPlot('it'), nations)
+    for nation in nations:
+        g.panel(nation).plot(*extract('Confirmed', nation), label='Total cases', **Styles.totalecasi)
+        g.panel(nation).plot(*extract('Deaths', nation), label='Deaths', **Styles.deceduti)
+        g.panel(nation).expfit(*extract('Confirmed', nation), **Styles.expfit1)
+        g.panel(nation).expfit(*extract('Deaths', nation), **Styles.expfit2)
+    return g.save(crops=os.path.join(outdir, '%s.png'))
+
+def nations_daily(nations):
+    g = GridPlot(DailyPlot('en'), nations)
+    for nation in nations:
+        g.panel(nation).plot_daily(*world_metrics.daily_series(nation, 'Confirmed'), label='New cases', **Styles.totalecasi)
+        g.panel(nation).plot_daily(*world_metrics.daily_series(nation, 'Deaths'), label='Deaths', **Styles.deceduti)
+    return g.save(crops=os.path.join(outdir, '%s_daily.png'))
+
+def nations_oo(nations, column, suffix, **labels):
+    g = GridPlot(OOPlot('en', **labels), nations)
+    for nation in nations:
+        _, cases = extract(column, nation)
+        g.panel(nation).plot(cases, smooth=False, **Styles.faintline)
+        g.panel(nation).plot_curve(world_metrics.smoothed_series(nation, column))
+    return g.save(crops=os.path.join(outdir, '%s_' + suffix + '.png'))
+
+def nations_cases_oo(nations):
+    return nations_oo(nations, 'Confirmed', 'cases_oo')
+
+def nations_deaths_oo(nations):
+    return nations_oo(nations, 'Deaths', 'deaths_oo',
+                      xlabel='NumberOfDeaths', ylabel='NumberOfDailyDeaths')
+
+def nations_doubling(nations):
+    g = GridPlot(DoublingTimePlot('en'), nations)
+    for nation in nations:
+        g.panel(nation).plot(*world_metrics.doubling_series(nation, 'Confirmed'), label='Cases', **Styles.totalecasi)
+        g.panel(nation).plot(*world_metrics.doubling_series(nation, 'Deaths'), label='Deaths', **Styles.deceduti)
+    return g.save(crops=os.path.join(outdir, '%s_doubling.png'))
+
+if small_multiples:
+    nation_charts = [(nations_cases, 4, small_multiples),
+                     (nations_daily, 2, small_multiples),
+                     (nations_cases_oo, 2, small_multiples),
+                     (nations_deaths_oo, 2, small_multiples),
+                     (nations_doubling, 2, small_multiples)]
+
+builder = PageBuilder(outdir)
+
+def worker_state():
+    # Globals used by the charts drawn in the workers
+    return (worker_state, {'world': world, 'world_metrics': world_metrics})
+
+def submit(scheduler):
+    builder.submit(scheduler, 'nations', nation_charts, sorted(nations_list()),
+                   world.digests())
+
+def write_index(last_update):
+
+    # Data for viewer.html, written while the workers draw
+    export.write(outdir, 'nations', world, world_metrics, ['Confirmed', 'Deaths'])
+
+    with builder.index() as f:
+        f.write('Last update: %s<br>' % last_update)
+        f.write('<a href="nations_summary.html">Summary</a><br>')
+
+        for nation in sorted(nations_list()):
+            f.write('<a href="#%s">%s</a> ' % (nation, nation))
+
+        builder.write_section(f, 'nations', sorted(nations_list()))
+
+    summary.write(builder, outdir, 'nations', world_metrics, [('Confirmed', 'Cases'), ('Deaths', 'Deaths')],
+                  'Nation', title='Nations')
+
+    builder.write_report()
+
+
+if __name__ == '__main__':
+    last_update = sys.argv[1]
+    check_settings()
+    load()
+    scheduler = Scheduler()
+    submit(scheduler)
+    with shared.pool(n_proc, [worker_state()]) as pool:
+        scheduler.start(pool)
+        write_index(last_update)
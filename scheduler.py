@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+
+def run_task(task):
+    group, func, args = task
+    return group, func(*args)
+
+
+class Scheduler():
+
+    # Collects small tasks (typically one per plot) from all the pages
+    # being built, and dispatches them to a single Pool, longest first.
+    # Tasks are handed out one at a time as workers become free, so
+    # a few expensive entities do not leave the other workers idle at
+    # the end of a statically chunked map.
+    #
+    # Each task belongs to a group (e.g. one section of a page), and
+    # wait(group) returns the results of that group once all its tasks
+    # are done, keeping aside those of other groups completed meanwhile.
+
+    def __init__(self):
+        self.tasks = []
+        self.pending = {}
+        self.done = {}
+        self.results = None
+
+    def add(self, group, cost, func, *args):
+        self.tasks.append((cost, group, func, args))
+        self.pending[group] = self.pending.get(group, 0) + 1
+
+    def start(self, pool):
+        self.tasks.sort(key=lambda task: task[0], reverse=True)
+        tasks = [(group, func, args) for _, group, func, args in self.tasks]
+        self.tasks = []
+        self.results = pool.imap_unordered(run_task, tasks)
+
+    def wait(self, group):
+        while self.pending.get(group):
+            g, result = next(self.results)
+            self.done.setdefault(g, []).append(result)
+            self.pending[g] -= 1
+        return self.done.pop(group, [])
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+# Optional settings shared by all scripts, read from my_config_covid.py
+
+try:
+    import my_config_covid as config
+except ModuleNotFoundError:
+    config = None
+
+def setting(name, default):
+    return getattr(config, name, default)
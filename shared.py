@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import atexit
+import importlib
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+from settings import setting
+
+# Start method of the worker processes ('fork', 'spawn', 'forkserver'),
+# None for the platform default
+start_method = setting('start_method', None)
+# Modules imported once by the forkserver process, which the workers
+# then inherit. None for the main script and what drawing needs.
+preload = setting('preload', None)
+
+# Blocks created by this process, by address of their first byte
+created = {}
+# Blocks attached by this process, kept open while it runs
+attached = {}
+# Arrays mapped from files, by address: (filename, offset, array)
+mapped = {}
+
+
+class SharedRef():
+
+    # Pickled in place of an array published in shared memory
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+class MappedRef():
+
+    # Pickled in place of an array mapped from a file
+
+    def __init__(self, filename, offset, shape, dtype):
+        self.filename = filename
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+def map_file(filename, dtype, offset, shape):
+
+    # Read only np.memmap of part of a file. Processes that map the same
+    # file share its pages already, so these arrays are never copied to
+    # shared memory but pickled as a reference to the file.
+    array = np.memmap(filename, dtype, 'r', offset, tuple(shape))
+    mapped[array.__array_interface__['data'][0]] = (filename, offset, array)
+    return array
+
+def publish(array):
+
+    # Returns a copy of array backed by a new shared memory block
+    if isinstance(array, np.ndarray) and array.__array_interface__['data'][0] in mapped:
+        return array
+    array = np.asarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, array.dtype, buffer=shm.buf)
+    view[...] = array
+    created[view.__array_interface__['data'][0]] = (shm, os.getpid())
+    return view
+
+def reference(array):
+
+    # What to pickle for array: a reference if it is a published block
+    if isinstance(array, np.ndarray) and array.__array_interface__['data'][0] in created:
+        shm, _ = created[array.__array_interface__['data'][0]]
+        return SharedRef(shm.name, array.shape, array.dtype.str)
+    if isinstance(array, np.ndarray) and array.__array_interface__['data'][0] in attached:
+        ref, _ = attached[array.__array_interface__['data'][0]]
+        return ref
+    if isinstance(array, np.ndarray) and array.__array_interface__['data'][0] in mapped:
+        filename, offset, _ = mapped[array.__array_interface__['data'][0]]
+        return MappedRef(filename, offset, array.shape, array.dtype.str)
+    return array
+
+def attach(ref):
+
+    # Inverse of reference(): maps the block without copying it
+    if isinstance(ref, MappedRef):
+        return map_file(ref.filename, ref.dtype, ref.offset, ref.shape)
+    if not isinstance(ref, SharedRef):
+        return ref
+    shm = shared_memory.SharedMemory(name=ref.name)
+    view = np.ndarray(ref.shape, np.dtype(ref.dtype), buffer=shm.buf)
+    attached[view.__array_interface__['data'][0]] = (ref, shm)
+    return view
+
+@atexit.register
+def unlink():
+    for shm, pid in created.values():
+        if pid == os.getpid():
+            shm.unlink()
+
+
+def init_worker(states):
+
+    # Sets the module globals listed in states, a list of
+    # (owner, {name: value}), where owner is a module name or a function
+    # of the module. With the fork start method they are already there;
+    # otherwise they arrive here pickled, with the arrays in shared memory
+    # sent as references. A function is needed for the main script: when
+    # spawned, its functions see the namespace it was run in, not the
+    # __main__ module.
+    for owner, values in states:
+        if callable(owner):
+            owner.__globals__.update(values)
+        else:
+            module = sys.modules.get(owner) or importlib.import_module(owner)
+            for name, value in values.items():
+                setattr(module, name, value)
+
+def pool(n_proc, states):
+
+    # Pool whose workers see the given module globals whatever the start
+    # method, plus the plot cache of this process
+    from covid import plot_cache, renderer
+    states = states + [('covid', {'plot_cache': plot_cache})]
+    context = multiprocessing.get_context(start_method)
+    if context.get_start_method() == 'forkserver':
+        modules = preload
+        if modules is None:
+            modules = ['__main__', 'covid', 'matplotlib.dates', 'scipy.signal']
+            if renderer == 'agg':
+                modules += ['matplotlib.figure', 'matplotlib.backends.backend_agg']
+            else:
+                modules += ['matplotlib.pyplot']
+        context.set_forkserver_preload(modules)
+    return context.Pool(n_proc, initializer=init_worker, initargs=(states,))
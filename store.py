@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Binary store of a Dataset, read back with np.memmap.
+#
+# Layout: an 8 byte magic, the length of a JSON header as a little
+# endian uint64, the header, then each array in C order, aligned to 64
+# bytes. The header holds the entity names, the date origin and the
+# offsets of the dates from it in days, the labels of the entities, the
+# stamp of the source files, and dtype, shape and offset of each array.
+# Counts are stored as int32 when they fit, int64 otherwise.
+#
+# Usage: store.py FILE...    prints a summary of each store
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+import shared
+from settings import setting
+
+# Directory of the stores written by the loaders, None to always
+# parse the CSV files
+store_dir = setting('store_dir', os.path.expanduser('~/.cache/covid_plots/store'))
+
+magic = b'COVIDTS1'
+align = 64
+
+
+def stamp(filenames):
+
+    # Size and mtime of each source file: a store is valid only
+    # while these match
+    stamps = []
+    for filename in filenames:
+        st = os.stat(filename)
+        stamps.append([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+    return stamps
+
+def counts(m):
+    if m.size == 0 or (m.min() >= np.iinfo('int32').min and m.max() <= np.iinfo('int32').max):
+        return m.astype('<i4')
+    return m.astype('<i8')
+
+def padding(offset):
+    return -offset % align
+
+def write(filename, dataset, sources):
+
+    # The store replaces the previous one only when complete
+    dates = dataset.dates.values.astype('datetime64[D]')
+    origin = dates[0] if len(dates) else np.datetime64('1970-01-01', 'D')
+    arrays = [('offsets', (dates - origin).astype('<i4')),
+              ('present', dataset.present.astype('u1'))]
+    arrays += [('column:' + column, counts(m)) for column, m in dataset.columns.items()]
+
+    header = {'names': list(dataset.names),
+              'origin': str(origin),
+              'labels': dataset.labels,
+              'stamp': sources,
+              'arrays': []}
+    offset = 0
+    for name, a in arrays:
+        header['arrays'].append({'name': name, 'dtype': a.dtype.str, 'shape': a.shape, 'offset': offset})
+        offset += a.nbytes + padding(a.nbytes)
+    header = json.dumps(header).encode()
+    start = len(magic) + 8 + len(header)
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(magic)
+        f.write(np.uint64(len(header)).astype('<u8').tobytes())
+        f.write(header)
+        f.write(b'\0' * padding(start))
+        for name, a in arrays:
+            f.write(np.ascontiguousarray(a).tobytes())
+            f.write(b'\0' * padding(a.nbytes))
+    os.replace(tmp, filename)
+
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError('%s is not a dataset store' % filename)
+        length = int(np.frombuffer(f.read(8), '<u8')[0])
+        header = json.loads(f.read(length))
+    start = len(magic) + 8 + length
+    return header, start + padding(start)
+
+def read(filename):
+
+    # Returns names, dates, columns, presence mask and labels. Counts
+    # and mask are mapped read only, and pages are read from disk only
+    # when an entity is accessed.
+    header, start = read_header(filename)
+    arrays = {}
+    for a in header['arrays']:
+        if np.prod(a['shape']) == 0:
+            arrays[a['name']] = np.zeros(a['shape'], a['dtype'])
+        else:
+            arrays[a['name']] = shared.map_file(filename, a['dtype'], start + a['offset'], a['shape'])
+    dates = np.datetime64(header['origin'], 'D') + np.asarray(arrays.pop('offsets'))
+    present = arrays.pop('present').view(bool)
+    columns = {name[len('column:'):]: m for name, m in arrays.items()}
+    return header['names'], dates, columns, present, header.get('labels', {})
+
+def path(sources, params):
+
+    # Store of the given source files parsed with the given parameters.
+    # The key is the first file, the directories of the files and the
+    # parameters, not the whole list: a loader whose list grows every
+    # day (the daily reports of us.py) keeps replacing the same store,
+    # which stamp() invalidates.
+    if store_dir is None:
+        return None
+    sources = [os.path.abspath(source) for source in sources]
+    dirs = sorted(set(os.path.dirname(source) for source in sources))
+    key = hashlib.sha1(json.dumps([sources[:1], dirs, params]).encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(sources[0]))[0] if sources else 'empty'
+    return os.path.join(store_dir, '%s-%s.cvds' % (name, key))
+
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        header, _ = read_header(filename)
+        names, dates, columns, present, labels = read(filename)
+        print('%s: %d entities, %d dates from %s to %s' %
+              (filename, len(names), len(dates),
+               dates[0] if len(dates) else '-', dates[-1] if len(dates) else '-'))
+        for column, m in columns.items():
+            print('    %-24s %s' % (column, m.dtype))
+        for label in labels:
+            print('    %-24s label' % label)
+        for source, size, _ in header['stamp']:
+            print('    from %s (%d bytes)' % (source, size))
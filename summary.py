@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Overview page of a section: a sortable league table of all entities
+# with the latest values, the new values of the last 7 days and their
+# change from the 7 days before, the current doubling time, and the
+# totals and new values per 100k inhabitants where the population is
+# known, plus charts overlaying the top entities. Everything comes from the
+# entity x date matrices of Metrics, in one pass over all entities.
+
+import os
+import numpy as np
+
+from covid import i18n, DailyPlot, DoublingTimePlot
+from pages import ranking_table
+from settings import setting
+from timing import timer
+
+# Number of entities overlaid in the charts of the overview pages
+summary_top = setting('summary_top', 10)
+
+# Shown without decimals
+counts = {'Latest', 'NewToday', 'NewLastWeek'}
+
+# Sorts a table.sortable by the column clicked, by the data-v value of
+# the cells when they have one
+sort_script = '''<script>
+document.querySelectorAll('table.sortable th').forEach((th, c) => th.addEventListener('click', () => {
+  const table = th.closest('table'), rows = Array.from(table.rows).slice(1);
+  const key = row => { const v = row.cells[c].dataset.v;
+                       return v === undefined ? row.cells[c].textContent : v === '' ? -Infinity : +v; };
+  const dir = th.dataset.dir = th.dataset.dir === 'desc' ? 'asc' : 'desc';
+  rows.sort((a, b) => { const x = key(a), y = key(b);
+                        const d = typeof x === 'string' ? x.localeCompare(y) : x - y;
+                        return dir === 'asc' ? d : -d; });
+  rows.forEach(row => table.tBodies[0].appendChild(row));
+}));
+</script>
+'''
+
+
+def league(metrics, column, n=7):
+
+    # Values at the last date of every entity, as vectors
+    rolling = metrics.rolling(column, n)
+    new = rolling[:, -1] * n
+    before = rolling[:, -1-n] * n if rolling.shape[1] > n else np.full(len(new), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.where(before > 0, 100 * (new / before - 1), np.nan)
+    table = {'Latest': metrics.filled(column)[:, -1],
+             'NewToday': metrics.daily(column)[:, -1],
+             'NewLastWeek': new,
+             'WeeklyChange': change,
+             'DoublingTime': metrics.doubling_time(column)[:, -1]}
+    if metrics.population is not None:
+        table['Per100k'] = metrics.per_100k(column)[:, -1]
+        table['NewLastWeekPer100k'] = metrics.new_per_100k(column, n)[:, -1]
+    return table
+
+def write(builder, outdir, section, metrics, columns, heading, lang='en', title=None, n=7, names=None):
+
+    # Writes <outdir>/<section>_summary.html. columns are (column,
+    # label) pairs, heading is that of the column of the names. Entities
+    # are ranked by the new values of the last n days of the first
+    # column per 100k inhabitants, then those without a population by
+    # the new values alone, and the first summary_top of them are
+    # overlaid. names restricts the table to the entities of the index,
+    # all by default.
+    with timer.stage('summary'):
+        if names is None:
+            names = metrics.dataset.names
+        listed = np.array([metrics.dataset.index[name] for name in names], dtype=np.intp)
+        tables = [(label, {key: values[listed] for key, values in league(metrics, column, n).items()})
+                  for column, label in columns]
+        headers = ['%s: %s' % (label, i18n[lang][key]) for label, table in tables for key in table]
+        new = tables[0][1]['NewLastWeek']
+        per_100k = tables[0][1].get('NewLastWeekPer100k', np.full(len(new), np.nan))
+        order = np.lexsort((np.where(np.isfinite(new), -new, np.inf),
+                            np.where(np.isfinite(per_100k), -per_100k, np.inf)))
+        rows = [[names[i]] + [int(round(values[i])) if key in counts and np.isfinite(values[i])
+                              else float(values[i])
+                              for _, table in tables for key, values in table.items()]
+                for i in order]
+        top = [i for i in order[:summary_top] if np.isfinite(new[i])]
+
+    column, label = columns[0]
+    peak = np.nanmax(metrics.rolling(column, n)[listed[top]]) if top else 0
+    p = DailyPlot(lang, title='%s - %s' % (label, i18n[lang]['DailyMean']),
+                  ymax=float(10 ** np.ceil(np.log10(max(peak * 2, 10)))))
+    for i in top:
+        p.plot_daily(*metrics.rolling_series(names[i], column, n), label=names[i])
+    charts = p.save(os.path.join(outdir, '%s_summary_daily.png' % section))
+    p = DoublingTimePlot(lang, title='%s - %s' % (label, i18n[lang]['DoublingTime']))
+    for i in top:
+        p.plot(*metrics.doubling_series(names[i], column), label=names[i])
+    charts += p.save(os.path.join(outdir, '%s_summary_doubling.png' % section))
+
+    with builder.index('%s_summary.html' % section) as f:
+        f.write('<a href="index.html">%s</a>\n' % i18n[lang]['Index'])
+        if title is not None:
+            f.write('<H1>%s</H1>\n' % title)
+        f.write(charts)
+        f.write(ranking_table([heading] + headers, rows, sortable=True))
+        f.write(sort_script)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import time
+import json
+from contextlib import contextmanager
+
+
+class Timer():
+
+    # Wall and CPU time spent by this process in each stage (csv
+    # loading, fits, smoothing, figures, savefig, html) and in each
+    # entity. Stages can be nested, e.g. 'fit' happens while drawing
+    # an entity. Pool workers send their totals back with the result of
+    # each task (see PageBuilder), and the parent merges them.
+
+    def __init__(self):
+        self.stages = {}
+        self.entities = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += time.perf_counter() - wall
+            s[2] += time.process_time() - cpu
+
+    @contextmanager
+    def entity(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            e = self.entities.setdefault(name, [0.0, 0.0])
+            e[0] += time.perf_counter() - wall
+            e[1] += time.process_time() - cpu
+
+    def split(self, name, names):
+
+        # Shares the time of entity name evenly among names, e.g. that
+        # of a grid of charts among the entities in it
+        wall, cpu = self.entities.pop(name, (0.0, 0.0))
+        for n in names:
+            e = self.entities.setdefault(n, [0.0, 0.0])
+            e[0] += wall / len(names)
+            e[1] += cpu / len(names)
+
+    def take(self):
+
+        # Returns the totals so far and starts again from zero
+        taken = (self.stages, self.entities)
+        self.stages = {}
+        self.entities = {}
+        return taken
+
+    def merge(self, taken):
+        stages, entities = taken
+        for name, (count, wall, cpu) in stages.items():
+            s = self.stages.setdefault(name, [0, 0.0, 0.0])
+            s[0] += count
+            s[1] += wall
+            s[2] += cpu
+        for name, (wall, cpu) in entities.items():
+            e = self.entities.setdefault(name, [0.0, 0.0])
+            e[0] += wall
+            e[1] += cpu
+
+    def slowest(self, n=None):
+        names = sorted(self.entities, key=lambda name: self.entities[name][0], reverse=True)
+        return names[:n]
+
+    def report(self, filename):
+        report = {
+            'stages': {name: {'count': count, 'wall': wall, 'cpu': cpu}
+                       for name, (count, wall, cpu) in sorted(self.stages.items())},
+            'entities': [{'name': name, 'wall': self.entities[name][0], 'cpu': self.entities[name][1]}
+                         for name in self.slowest()],
+        }
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1)
+
+# Totals of this process
+timer = Timer()
@@ -2,11 +2,20 @@
 
 import sys
 import os.path
+import numpy as np
 import pandas as pd
 from datetime import date, timedelta
-from multiprocessing import Pool
 
-from covid import i18n, Styles, CovidPlot, DailyPlot, OOPlot
+from covid import i18n, Styles, CovidPlot, DailyPlot, DoublingTimePlot, OOPlot, plot_cache
+from dataset import Dataset
+from metrics import Metrics
+from pages import PageBuilder, check_settings
+from scheduler import Scheduler
+import export
+import population
+import summary
+import shared
+from timing import timer
 
 
 try:
@@ -16,10 +25,14 @@ except ModuleNotFoundError:
     csv_dir = '../COVID-19-world/csse_covid_19_data/csse_covid_19_daily_reports'
     homedir = os.getenv('HOME')
     outdir = os.path.join(homedir, 'public_html/coronavirus/us')
-    n_proc = 1
-    
+    n_proc = os.cpu_count()
+
+try:
+    from my_config_us import cache_dir
+
+except ImportError:
+    cache_dir = os.path.expanduser('~/.cache/covid_plots/us')
 
-last_update = sys.argv[1]
 
 def states_list():
 
@@ -44,81 +57,168 @@ def parse_old_csv(filename, date):
 def parse_new_csv(filename, date):
     a = pd.read_csv(filename)
     b = a.loc[ a['Country_Region'] == 'US']
-    c = b.groupby('Province_State').sum().reset_index()
+    c = b.groupby('Province_State')[['Confirmed', 'Deaths']].sum().reset_index()
     d = c[['Province_State', 'Confirmed', 'Deaths']].copy()
     d['Last Update'] = date
     d = d.rename(columns={'Province_State': 'Province/State'})
     return d
 
+def parse_cached(parse, filename, date):
+
+    # Per-state totals of each report are cached as .npz, stamped with
+    # the size and mtime of the source file. Only new or changed
+    # reports are parsed again.
+    st = os.stat(filename)
+    stamp = [st.st_size, st.st_mtime_ns]
+    cached = os.path.join(cache_dir, os.path.basename(filename)[:-4] + '.npz')
+    try:
+        with np.load(cached) as npz:
+            if npz['stamp'].tolist() == stamp:
+                return pd.DataFrame({'Province/State': npz['states'],
+                                     'Confirmed': npz['confirmed'],
+                                     'Deaths': npz['deaths'],
+                                     'Last Update': date})
+    except (OSError, KeyError, ValueError):
+        pass
+
+    with timer.stage('load'):
+        f = parse(filename, date)
+    tmp = cached + '.tmp'
+    with open(tmp, 'wb') as out:
+        np.savez(out, stamp=np.array(stamp),
+                      states=f['Province/State'].to_numpy().astype(str),
+                      confirmed=f['Confirmed'].to_numpy(),
+                      deaths=f['Deaths'].to_numpy())
+    os.replace(tmp, cached)
+    return f
+
 def parse_all(csv_dir):
 
+    os.makedirs(cache_dir, exist_ok=True)
+
     # Previous format
     dates = pd.date_range('2020-03-10', '2020-03-21')
-    f = [(os.path.join(csv_dir, date.strftime('%m-%d-%Y')+'.csv'), date) for date in dates]
-    csv_old = [parse_old_csv(fname, date) for fname,date in f]
+    f_old = [(os.path.join(csv_dir, date.strftime('%m-%d-%Y')+'.csv'), date) for date in dates]
 
     # New format
     dates = pd.date_range('2020-03-22', date.today() - timedelta(days=1))
-    f = [(os.path.join(csv_dir, date.strftime('%m-%d-%Y')+'.csv'), date) for date in dates]
-    csv_new = [parse_new_csv(fname, date) for fname,date in f]
-    return pd.concat(csv_old + csv_new)
+    f_new = [(os.path.join(csv_dir, date.strftime('%m-%d-%Y')+'.csv'), date) for date in dates]
+
+    # Reports are parsed only when one of them changed since the
+    # dataset was last stored
+    def parse():
+        csv_old = [parse_cached(parse_old_csv, fname, date) for fname,date in f_old]
+        csv_new = [parse_cached(parse_new_csv, fname, date) for fname,date in f_new]
+        return Dataset.from_frame(pd.concat(csv_old + csv_new), 'Province/State',
+                                  ['Confirmed', 'Deaths'], date_column='Last Update')
+
+    return Dataset.cached([fname for fname, _ in f_old + f_new], ['us'], parse)
 
 def extract(csv_all, state, column_name):
 
-    df = csv_all.loc[ csv_all['Province/State'] == state]
-    date = pd.to_datetime(df['Last Update']).dt.floor('d')
-    series = df[column_name]
+    return csv_all.series(state, column_name)
 
-    return (date, series.to_numpy().astype('int64'))
-    
-try:
-    os.makedirs(outdir)
-except FileExistsError:
-    pass
+def load():
+    global csv_all, csv_metrics, states
+
+    # Parsed before the Pool is created, and moved to shared memory so
+    # that the workers map it instead of copying it
+    csv_all = parse_all(csv_dir)
+    csv_metrics = Metrics(csv_all, population.vector('states', csv_all.names))
+    csv_metrics.precompute(['Confirmed', 'Deaths'])
+    csv_all.share()
+    csv_metrics.share()
+    states = sorted(states_list())
 
-def plot_state(state):
-    print(state)
-    html = '<H2>%s</H2><a name="%s"></a>' % (state, state)
+    try:
+        os.makedirs(outdir)
+    except FileExistsError:
+        pass
 
+    # Images whose inputs did not change since the last run are not redrawn
+    plot_cache.load(outdir)
+
+    # Loading times go to the report of this site
+    builder.timer.merge(timer.take())
+
+def state_cases(state):
     p = CovidPlot('en', title=state)
     p.plot(*extract(csv_all, state, 'Confirmed'), label='Total cases', **Styles.totalecasi)
     p.plot(*extract(csv_all, state, 'Deaths'), label='Deaths', **Styles.deceduti)
     p.expfit(*extract(csv_all, state, 'Confirmed'), **Styles.expfit1)
     p.expfit(*extract(csv_all, state, 'Deaths'), **Styles.expfit2)
-    html += p.save(os.path.join(outdir,'%s.png' % state))
+    return p.save(os.path.join(outdir,'%s.png' % state))
 
+def state_daily(state):
     p = DailyPlot('en', title='%s - daily cases' % state)
-    p.plot(*extract(csv_all, state, 'Confirmed'), label='New cases', **Styles.totalecasi)
-    p.plot(*extract(csv_all, state, 'Deaths'), label='Deaths', **Styles.deceduti)
-    html += p.save(os.path.join(outdir, '%s_daily.png' % state))
+    p.plot_daily(*csv_metrics.daily_series(state, 'Confirmed'), label='New cases', **Styles.totalecasi)
+    p.plot_daily(*csv_metrics.daily_series(state, 'Deaths'), label='Deaths', **Styles.deceduti)
+    return p.save(os.path.join(outdir, '%s_daily.png' % state))
 
+def state_cases_oo(state):
     p = OOPlot('en', title='%s - Cases' % state)
     _, cases = extract(csv_all, state, 'Confirmed')
     p.plot(cases, smooth=False, **Styles.faintline)
-    p.plot(cases)
-    html += p.save(os.path.join(outdir, '%s_cases_oo.png' % state))
+    p.plot_curve(csv_metrics.smoothed_series(state, 'Confirmed'))
+    return p.save(os.path.join(outdir, '%s_cases_oo.png' % state))
 
+def state_deaths_oo(state):
     p = OOPlot('en', title='%s - Deaths' % state,
                        xlabel='NumberOfDeaths',
                        ylabel='NumberOfDailyDeaths')
     _, cases = extract(csv_all, state, 'Deaths')
     p.plot(cases, smooth=False, **Styles.faintline)
-    p.plot(cases)
-    html += p.save(os.path.join(outdir, '%s_deaths_oo.png' % state))
-    return html
+    p.plot_curve(csv_metrics.smoothed_series(state, 'Deaths'))
+    return p.save(os.path.join(outdir, '%s_deaths_oo.png' % state))
 
-with open(os.path.join(outdir, 'index.html'), 'w') as f:
+def state_doubling(state):
+    p = DoublingTimePlot('en', title='%s - doubling time' % state)
+    p.plot(*csv_metrics.doubling_series(state, 'Confirmed'), label='Cases', **Styles.totalecasi)
+    p.plot(*csv_metrics.doubling_series(state, 'Deaths'), label='Deaths', **Styles.deceduti)
+    return p.save(os.path.join(outdir, '%s_doubling.png' % state))
 
-    csv_all = parse_all(csv_dir)
+# Charts of each state, with their relative cost (number of series)
+state_charts = [(state_cases, 4),
+                (state_daily, 2),
+                (state_cases_oo, 2),
+                (state_deaths_oo, 2),
+                (state_doubling, 2)]
+
+builder = PageBuilder(outdir)
+
+def worker_state():
+    # Globals used by the charts drawn in the workers
+    return (worker_state, {'csv_all': csv_all, 'csv_metrics': csv_metrics})
+
+def submit(scheduler):
+    builder.submit(scheduler, 'states', state_charts, states, csv_all.digests())
+
+def write_index(last_update):
+
+    # Data for viewer.html, written while the workers draw
+    export.write(outdir, 'states', csv_all, csv_metrics, ['Confirmed', 'Deaths'], states)
+
+    with builder.index() as f:
 
-    f.write('Last update: %s<br>' % last_update)
-    for state in sorted(states_list()):
-        f.write('<a href="#%s">%s</a> ' % (state, state))
+        f.write('Last update: %s<br>' % last_update)
+        f.write('<a href="states_summary.html">Summary</a><br>')
+        for state in states:
+            f.write('<a href="#%s">%s</a> ' % (state, state))
 
-    with Pool(n_proc) as p:
-        html = p.map(plot_state, sorted(states_list()))
+        builder.write_section(f, 'states', states)
 
-    f.write('\n'.join(html))
+    summary.write(builder, outdir, 'states', csv_metrics, [('Confirmed', 'Cases'), ('Deaths', 'Deaths')],
+                  'State', title='States', names=states)
 
+    builder.write_report()
 
 
+if __name__ == '__main__':
+    last_update = sys.argv[1]
+    check_settings()
+    load()
+    scheduler = Scheduler()
+    submit(scheduler)
+    with shared.pool(n_proc, [worker_state()]) as pool:
+        scheduler.start(pool)
+        write_index(last_update)